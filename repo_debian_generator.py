@@ -32,41 +32,62 @@
 
 from __future__ import print_function
 
+import atexit
 import collections
+import contextlib
 import datetime
+import email.utils
+import fnmatch
+import functools
+import hashlib
+import heapq
 import io
+import itertools
 import json
 import os
-import pkg_resources
+import pickle
 import re
 import shutil
+import stat
 import sys
+import tempfile
+import threading
+import time
 import traceback
 
+from subprocess import CalledProcessError
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+
 # Python 2/3 support.
 try:
     from configparser import SafeConfigParser
 except ImportError:
     from ConfigParser import SafeConfigParser
-from dateutil import tz
-from pkg_resources import parse_version
-
-from bloom.generators import BloomGenerator
-from bloom.generators import GeneratorError
-from bloom.generators import update_rosdep
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+# packaging is much faster to import than pkg_resources
+try:
+    from packaging.version import parse as parse_version
+except ImportError:
+    from pkg_resources import parse_version
 
-from bloom.generators.common import default_fallback_resolver
-from bloom.generators.common import invalidate_view_cache
-from bloom.generators.common import evaluate_package_conditions
-from bloom.generators.common import resolve_rosdep_key
+# Heavy dependencies, e.g. bloom.generators which loads rosdistro and rosdep,
+# catkin_pkg.changelog which loads docutils, empy and dateutil are imported
+# by the functions using them, so e.g. --help and --place-template-files do
+# not pay for them.
 
 from bloom.git import inbranch
 from bloom.git import get_branches
-from bloom.git import get_commit_hash
-from bloom.git import get_current_branch
-from bloom.git import has_changes
-from bloom.git import show
-from bloom.git import tag_exists
+from bloom.git import get_root
 
 from bloom.logging import ansi
 from bloom.logging import debug
@@ -75,57 +96,370 @@ from bloom.logging import error
 from bloom.logging import fmt
 from bloom.logging import info
 from bloom.logging import is_debug
+from bloom.logging import strip_ansi
 from bloom.logging import warning
 
-from bloom.commands.git.patch.common import get_patch_config
-from bloom.commands.git.patch.common import set_patch_config
-
-from bloom.packages import get_package_data
-
-from bloom.util import code
+from bloom.util import check_output
 from bloom.util import to_unicode
-from bloom.util import execute_command
 from bloom.util import get_rfc_2822_date
 from bloom.util import maybe_continue
 
-# importing shutil module
-import shutil
+# Drop the first log prefix for this command
+enable_drop_first_log_prefix(True)
 
-try:
-    from catkin_pkg.changelog import get_changelog_from_path
-    from catkin_pkg.changelog import CHANGELOG_FILENAME
-except ImportError as err:
-    debug(traceback.format_exc())
-    error("catkin_pkg was not detected, please install it.", exit=True)
+# Same as catkin_pkg.changelog.CHANGELOG_FILENAME
+CHANGELOG_FILENAME = 'CHANGELOG.rst'
 
-try:
-    import rosdistro
-except ImportError as err:
-    debug(traceback.format_exc())
-    error("rosdistro was not detected, please install it.", exit=True)
 
-try:
-    import em
-except ImportError:
-    debug(traceback.format_exc())
-    error("empy was not detected, please install it.", exit=True)
+def _import_empy():
+    try:
+        import em
+    except ImportError:
+        debug(traceback.format_exc())
+        error("empy was not detected, please install it.", exit=True)
+    return em
+
+
+def get_changelog_from_rst(rst):
+    try:
+        from catkin_pkg.changelog import Changelog
+        from catkin_pkg.changelog import populate_changelog_from_rst
+    except ImportError:
+        debug(traceback.format_exc())
+        error("catkin_pkg was not detected, please install it.", exit=True)
+    changelog = Changelog()
+    populate_changelog_from_rst(changelog, rst)
+    return changelog
+
+
+def default_fallback_resolver(key, peer_packages):
+    from bloom.generators.common import default_fallback_resolver
+    return default_fallback_resolver(key, peer_packages)
+
+
+def package_conditional_context(ros_distro):
+    """
+    Return the context the conditions of format 3 package.xml files are
+    evaluated in for ros_distro, from the rosdep snapshot if one is enabled,
+    as bloom would otherwise fetch the rosdistro index for it.
+    """
+    if _rosdep_snapshot is not None:
+        return _rosdep_snapshot.get_context(ros_distro)
+    context = _conditional_contexts.get(ros_distro)
+    if context is None:
+        from bloom.generators.common import package_conditional_context
+        context = _conditional_contexts[ros_distro] = package_conditional_context(ros_distro)
+    return context
+
+
+# ros_distro -> condition context, see package_conditional_context
+_conditional_contexts = {}
+
+
+def evaluate_package_conditions(package, ros_distro):
+    """
+    Evaluate the conditional dependencies of package for ros_distro, like
+    bloom.generators.common.evaluate_package_conditions does.
+    """
+    # Conditions were introduced in package format 3, the dependencies of
+    # earlier formats are always used
+    if package.package_format >= 3:
+        package.evaluate_conditions(package_conditional_context(ros_distro))
+
+
+def invalidate_view_cache():
+    from bloom.generators.common import invalidate_view_cache
+    return invalidate_view_cache()
+
+
+def resolve_rosdep_key(key, os_name, os_version, ros_distro=None, ignored=None, retry=True):
+    from bloom.generators.common import resolve_rosdep_key
+    return resolve_rosdep_key(key, os_name, os_version, ros_distro, ignored, retry)
+
+
+def get_package_data(branch_name=None, directory=None, quiet=True, release_directory=None):
+    from bloom.packages import get_package_data
+    return get_package_data(branch_name, directory, quiet, release_directory)
 
-# Drop the first log prefix for this command
-enable_drop_first_log_prefix(True)
 
 TEMPLATE_EXTENSION = '.em'
 
+# The templates of each build type, next to this module
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+# Templates which are expanded once for each package of the repository
+PACKAGE_TEMPLATE_PREFIXES = ('control_package', 'install_package')
+
+# Build types which are built by configuring the repository root with CMake
+CMAKE_BUILD_TYPES = ['cmake', 'catkin', 'ament_cmake']
+
+# Build dependencies of the source package when it contains Python packages
+PYTHON_BUILD_DEPENDS = ['dh-python', 'python3-all', 'python3-setuptools']
+
+# Name of the source package of a repository, unless another one is given
+DEFAULT_SOURCE_PACKAGE = 'tesseract_core'
+
+# Compiler caches which can be used as the compiler launcher of the CMake packages
+COMPILER_CACHES = ['ccache', 'sccache']
+
+# Size of the chunks license files and generated files are streamed in
+CHUNK_SIZE = 64 * 1024
+
+
+class Timings(object):
+    """
+    Records the wall time of the stages of a run, optionally per item (a
+    package or a file), from any thread.
+    """
+
+    def __init__(self):
+        self.events = []
+        self._origin = time.time()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def measure(self, stage, item=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            with self._lock:
+                self.events.append((stage, item, start, end, threading.current_thread().ident))
+
+    def summarize(self):
+        """Return an OrderedDict mapping each stage to (count, total seconds, slowest item, its seconds)."""
+        summary = collections.OrderedDict()
+        with self._lock:
+            events = list(self.events)
+        for stage, item, start, end, _ in sorted(events, key=lambda e: e[2]):
+            count, total, slowest, slowest_time = summary.get(stage, (0, 0.0, None, 0.0))
+            if end - start >= slowest_time:
+                slowest, slowest_time = item, end - start
+            summary[stage] = (count + 1, total + end - start, slowest, slowest_time)
+        return summary
+
+    def print_summary(self):
+        info(fmt("@!@{bf}==>@| Timings:"))
+        info("  {0:<28} {1:>6} {2:>10}   {3}".format('stage', 'count', 'total [s]', 'slowest'))
+        for stage, (count, total, slowest, slowest_time) in self.summarize().items():
+            slowest = '{0} ({1:.3f} s)'.format(slowest, slowest_time) if slowest is not None else ''
+            info("  {0:<28} {1:>6} {2:10.3f}   {3}".format(stage, count, total, slowest))
+
+    def write_chrome_trace(self, path):
+        """Write the events in the Chrome trace event format, viewable in chrome://tracing or Perfetto."""
+        pid = os.getpid()
+        trace_events = []
+        with self._lock:
+            events = list(self.events)
+        for stage, item, start, end, tid in events:
+            event = {
+                'name': stage if item is None else '{0}: {1}'.format(stage, item),
+                'cat': stage,
+                'ph': 'X',
+                'ts': int((start - self._origin) * 1e6),
+                'dur': int((end - start) * 1e6),
+                'pid': pid,
+                'tid': tid,
+            }
+            if item is not None:
+                event['args'] = {'item': item}
+            trace_events.append(event)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+
+
+_timings = None
+
+
+def enable_timings():
+    """Start recording the timings of all subsequent timed() blocks."""
+    global _timings
+    _timings = Timings()
+    return _timings
+
+
+def timed(stage, item=None):
+    """Context manager recording the wall time of stage if timings are enabled."""
+    if _timings is None:
+        return _null_context()
+    return _timings.measure(stage, item)
+
+
+@contextlib.contextmanager
+def _null_context():
+    yield
+
+
+PACKAGE_MANIFEST_FILENAME = 'package.xml'
+
+# Folders containing one of these files are skipped, like catkin_pkg and colcon do
+IGNORE_MARKERS = set(['AMENT_IGNORE', 'CATKIN_IGNORE', 'COLCON_IGNORE'])
+
+
+def find_package_paths(basepath, exclude=None):
+    """
+    Return the paths relative to basepath of all folders containing a
+    package.xml, like catkin_pkg.packages.find_package_paths.
+
+    Folders containing an ignore marker, hidden folders and folders whose
+    path relative to basepath or name matches one of the exclude globs are
+    not searched, nor are the subfolders of packages. The paths are sorted
+    depth first by folder name, independent of the file system.
+    """
+    exclude = exclude or []
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(basepath, followlinks=True):
+        rel_path = os.path.relpath(dirpath, basepath)
+        if IGNORE_MARKERS.intersection(filenames) or (rel_path != os.curdir and any(
+                fnmatch.fnmatch(rel_path, g) or fnmatch.fnmatch(os.path.basename(dirpath), g) for g in exclude)):
+            del dirnames[:]
+            continue
+        if PACKAGE_MANIFEST_FILENAME in filenames:
+            paths.append(rel_path)
+            del dirnames[:]
+            continue
+        # Sorted, so the packages are found in the same order on every file system
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+    return paths
+
+
+class PackageIndex(object):
+    """
+    Cache of parsed package.xml files, keyed by their absolute path and
+    validated by their mtime and size, which can be persisted between runs.
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, path=None):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        # package.xml path -> ((mtime, size), Package)
+        self._entries = {}
+        self._used = set()
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                data = pickle.load(f)
+        except Exception as exc:
+            warning("Ignoring unreadable package index '{0}': {1}".format(self.path, exc))
+            return
+        if isinstance(data, dict) and data.get('version') == self.FORMAT_VERSION:
+            self._entries = data['entries']
+
+    def save(self):
+        if self.path is None:
+            return
+        # Only keep the packages which were found, so the index does not grow forever
+        data = {
+            'version': self.FORMAT_VERSION,
+            'entries': dict((p, e) for p, e in self._entries.items() if p in self._used),
+        }
+        cache_dir = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.path)
+
+    def get(self, package_path):
+        try:
+            from catkin_pkg.package import parse_package
+        except ImportError:
+            debug(traceback.format_exc())
+            error("catkin_pkg was not detected, please install it.", exit=True)
+        manifest_path = os.path.abspath(os.path.join(package_path, PACKAGE_MANIFEST_FILENAME))
+        st = os.stat(manifest_path)
+        stat = (st.st_mtime, st.st_size)
+        self._used.add(manifest_path)
+        entry = self._entries.get(manifest_path)
+        if entry is not None and entry[0] == stat:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        package = parse_package(package_path)
+        self._entries[manifest_path] = (stat, package)
+        return package
+
+
+_package_index = None
+
+
+def enable_package_index(path=None):
+    """
+    Enable the package index for all subsequent calls to find_packages,
+    loading previously persisted entries from path.
+    """
+    global _package_index
+    _package_index = PackageIndex(path)
+    _package_index.load()
+    return _package_index
+
+
+def get_package_index():
+    return _package_index
+
+
+def find_packages(basepath, exclude=None):
+    """
+    Find and parse all packages in basepath, like
+    catkin_pkg.packages.find_packages, reusing the parsed package.xml files
+    of the package index which did not change.
+
+    :returns: dict mapping the paths relative to basepath to the packages
+    """
+    index = _package_index or enable_package_index()
+    packages = collections.OrderedDict()
+    names = {}
+    for path in find_package_paths(basepath, exclude):
+        package = index.get(os.path.join(basepath, path))
+        if package.name in names:
+            error("Multiple packages found with the same name '{0}': '{1}' and '{2}'"
+                  .format(package.name, names[package.name], path), exit=True)
+        names[package.name] = path
+        packages[path] = package
+    return packages
+
+
+def read_template_tree(path):
+    """Read the files below path into a dict mapping their paths relative to path to (content bytes, mode)."""
+    tree = {}
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if d not in ('.git', '.svn')]
+        for name in files:
+            file_path = os.path.join(root, name)
+            with open(file_path, 'rb') as f:
+                tree[os.path.relpath(file_path, path)] = (f.read(), stat.S_IMODE(os.stat(file_path).st_mode))
+    return tree
+
+
+def get_template_tree(build_type, gbp=False):
+    """
+    Return the templates of the debian folder of a repository of the given
+    build type, as read by read_template_tree from TEMPLATES_DIR.
+    """
+    tree = read_template_tree(os.path.join(TEMPLATES_DIR, build_type))
+    if not gbp:
+        tree.pop('gbp.conf.em', None)
+    # The stanzas of packages with another build type, e.g. the Python packages of a CMake repository
+    for other_build_type in sorted(os.listdir(TEMPLATES_DIR)):
+        control_package = os.path.join(TEMPLATES_DIR, other_build_type, 'control_package.em')
+        if other_build_type != build_type and os.path.isfile(control_package):
+            with open(control_package, 'rb') as f:
+                tree['control_package_{0}.em'.format(other_build_type)] = (
+                    f.read(), stat.S_IMODE(os.stat(control_package).st_mode))
+    return tree
+
+
 def place_template_files(path, build_type, gbp=False):
     info(fmt("@!@{bf}==>@| Placing templates files in the 'debian' folder."))
-    debian_path = os.path.join(path, 'debian')
-    # Remove the debian folder if it exist
-    if os.path.exists(debian_path):
-        shutil.rmtree(debian_path)
-    # Place template files
-    templates = os.path.join(os.curdir, os.path.join('templates', build_type))
-    shutil.copytree(os.path.join('templates', build_type), debian_path)
-    if not gbp:
-        os.remove(os.path.join(debian_path, 'gbp.conf.em'))
+    write_debian_tree(path, get_template_tree(build_type, gbp))
 
 
 def summarize_dependency_mapping(data, deps, build_deps, resolved_deps):
@@ -197,7 +531,262 @@ def format_description(value):
     return u"{0}.\n {1}".format(parts[0], parts[1].strip())
 
 
+# Version sections of a CHANGELOG.rst, e.g. '1.2.3 (2020-01-31)' underlined with dashes
+CHANGELOG_VERSION_REGEX = re.compile(r'^(?P<version>\d+\.\d+\.\d+) \(\d{4}-\d{2}-\d{2}\)\s*$')
+
+
+def truncate_changelog_rst(rst, depth=None, since=None):
+    """
+    Cut the text of a CHANGELOG.rst, which lists the newest version first,
+    after its newest depth version sections, or before the first version
+    section which is not newer than the version since. The newest section is
+    always kept.
+    """
+    if depth is None and since is None:
+        return rst
+    since_version = parse_version(since) if since is not None else None
+    lines = rst.splitlines(True)
+    sections = 0
+    for index, line in enumerate(lines[:-1]):
+        match = CHANGELOG_VERSION_REGEX.match(line)
+        if match is None or not lines[index + 1].startswith('-'):
+            continue
+        if sections and (
+                (depth is not None and sections >= depth) or
+                (since_version is not None and parse_version(match.group('version')) <= since_version)):
+            return ''.join(lines[:index])
+        sections += 1
+    return rst
+
+
+def parse_changelog(changelog_path, depth=None, since=None):
+    """
+    Parse a CHANGELOG.rst into a list of (version, date, changes) tuples,
+    newest first, with the date and changes formatted for debian/changelog.
+
+    With depth or since, only the versions kept by truncate_changelog_rst are
+    parsed, the older ones are never read by the rst parser.
+    """
+    with io.open(changelog_path, 'r', encoding='utf-8') as f:
+        changelog = get_changelog_from_rst(truncate_changelog_rst(f.read(), depth, since))
+    entries = []
+    for version, date, changes in changelog.foreach_version(reverse=True):
+        changes_str = []
+        date_str = get_rfc_2822_date(date)
+        for item in changes:
+            changes_str.extend(['  ' + i for i in to_unicode(item).splitlines()])
+        entries.append((version, date_str, '\n'.join(changes_str)))
+    return entries
+
+
+# Tags like '1.2.3', 'v1.2.3', 'my_pkg-1.2.3' or 'release/noetic/my_pkg/1.2.3-1',
+# the 'release/' prefix is no package, so 'release/1.2.3' is a repository wide tag
+RELEASE_TAG_REGEX = re.compile(r'^(?:release/)?(?:(?P<package>.+?)[-_/])?v?(?P<version>\d+\.\d+\.\d+)(?:-\d+)?$')
+
+
+def build_releaser_index(directory):
+    """
+    Build an index of who released which version from the tags of the git
+    repository containing directory, in a single pass over all tags.
+
+    Annotated tags are attributed to their tagger, lightweight tags to the
+    author of the tagged commit.
+
+    :returns: dict mapping (package name or None, version) to (name, email)
+    """
+    root = get_root(directory)
+    if root is None:
+        return {}
+    tag_format = '%(refname:short)%00%(taggername)%00%(taggeremail)%00%(authorname)%00%(authoremail)'
+    out = check_output(['git', 'for-each-ref', '--format=' + tag_format, 'refs/tags'], cwd=root)
+    index = {}
+    for line in out.splitlines():
+        fields = line.split('\0')
+        if len(fields) != 5:
+            continue
+        tag, tagger, tagger_email, author, author_email = fields
+        match = RELEASE_TAG_REGEX.match(tag)
+        if match is None:
+            continue
+        name, email = (tagger, tagger_email) if tagger else (author, author_email)
+        if not name:
+            continue
+        package = match.group('package')
+        if package is not None:
+            package = package.split('/')[-1]
+        index[(package, match.group('version'))] = (name, email.strip('<>'))
+    return index
+
+
+def get_release_tags_fingerprint(directory):
+    """
+    Return a hash over the tags of the git repository containing directory,
+    which build_releaser_index builds the releaser index from, or None if
+    directory is not in a git repository.
+    """
+    root = get_root(directory)
+    if root is None:
+        return None
+    out = check_output(['git', 'for-each-ref', '--format=%(refname)%00%(objectname)', 'refs/tags'], cwd=root)
+    return hashlib.sha1(out.encode('utf-8')).hexdigest()
+
+
+def get_releaser_history(releaser_index, package_name):
+    """Return the releaser history of a package, preferring package specific tags over repository wide ones."""
+    history = {}
+    for (package, version), releaser in releaser_index.items():
+        if package is None and version not in history:
+            history[version] = releaser
+    for (package, version), releaser in releaser_index.items():
+        if package == package_name:
+            history[version] = releaser
+    return history
+
+
+class ChangelogCache(object):
+    """
+    Parsed CHANGELOG.rst files keyed by the hash of their content, which can
+    be persisted to disk so unchanged changelogs are not parsed again, along
+    with the releaser index of the repository.
+
+    With depth or since, only the newest versions of each changelog are
+    parsed, see truncate_changelog_rst, and the repository changelog is
+    capped to depth versions.
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, path=None, depth=None, since=None):
+        self.path = path
+        self.depth = depth
+        self.since = since
+        self.releaser_index = None
+        self._entries = {}
+        self._used = set()
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError) as exc:
+            warning("Ignoring unreadable changelog cache '{0}': {1}".format(self.path, exc))
+            return
+        if data.get('version') != self.FORMAT_VERSION:
+            return
+        with self._lock:
+            self._entries = dict(
+                (digest, [tuple(e) for e in entries]) for digest, entries in data.get('entries', {}).items())
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            # Only keep the changelogs which were used, so the cache does not grow forever
+            data = {
+                'version': self.FORMAT_VERSION,
+                'entries': dict((d, e) for d, e in self._entries.items() if d in self._used),
+            }
+        cache_dir = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def _key(self, changelog_path):
+        key = _hash_file(changelog_path)
+        if self.depth is not None or self.since is not None:
+            # Truncated changelogs are cached separately from complete ones
+            key += ':{0}:{1}'.format(self.depth, self.since)
+        return key
+
+    def get(self, changelog_path):
+        digest = self._key(changelog_path)
+        with self._lock:
+            self._used.add(digest)
+            entries = self._entries.get(digest)
+        if entries is None:
+            entries = parse_changelog(changelog_path, self.depth, self.since)
+            with self._lock:
+                self._entries[digest] = entries
+        return entries
+
+    def parse_all(self, changelog_paths, jobs=1):
+        """Parse all changelogs which are not cached yet, using up to jobs processes."""
+        missing = {}
+        for changelog_path in changelog_paths:
+            digest = self._key(changelog_path)
+            with self._lock:
+                self._used.add(digest)
+                if digest not in self._entries:
+                    missing[digest] = changelog_path
+        parse = functools.partial(parse_changelog, depth=self.depth, since=self.since)
+        if jobs is None or jobs <= 1 or len(missing) <= 1:
+            parsed = [parse(p) for p in missing.values()]
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                parsed = list(executor.map(parse, missing.values()))
+        with self._lock:
+            self._entries.update(zip(missing.keys(), parsed))
+        return len(missing)
+
+
+_changelog_cache = None
+
+
+def enable_changelog_cache(path=None, depth=None, since=None):
+    """
+    Enable the changelog cache for all subsequent calls to get_changelogs,
+    loading previously persisted entries from path.
+
+    :param depth: number of the newest versions of each changelog to parse, or None for all of them
+    :param since: version or release tag, e.g. 'release/1.2.3', only the
+        versions newer than it are parsed, or None for all of them
+    """
+    global _changelog_cache
+    if depth is not None and depth < 1:
+        error("The changelog depth must be at least 1, got {0}".format(depth), exit=True)
+    if since is not None:
+        match = RELEASE_TAG_REGEX.match(since)
+        if match is None:
+            error("Expected a version or release tag like 'release/1.2.3', got '{0}'".format(since), exit=True)
+        since = match.group('version')
+    _changelog_cache = ChangelogCache(path, depth, since)
+    _changelog_cache.load()
+    return _changelog_cache
+
+
+def get_changelog_cache():
+    return _changelog_cache
+
+
+def load_changelogs(pkgs_dict, directory, jobs=1):
+    """
+    Batch changelog stage: build the releaser index of the repository in
+    directory and parse the CHANGELOG.rst of every package once, so the per
+    package get_changelogs calls are answered from the cache.
+    """
+    cache = _changelog_cache or enable_changelog_cache()
+    cache.releaser_index = build_releaser_index(directory)
+    changelog_paths = []
+    for pkg in pkgs_dict.values():
+        changelog_path = os.path.join(os.path.abspath(os.path.dirname(pkg.filename)), CHANGELOG_FILENAME)
+        if os.path.exists(changelog_path):
+            changelog_paths.append(changelog_path)
+    parsed = cache.parse_all(changelog_paths, jobs)
+    info("Parsed {0} of {1} changelogs, found {2} release tags".format(
+        parsed, len(changelog_paths), len(cache.releaser_index)))
+    return cache
+
+
 def get_changelogs(package, releaser_history=None):
+    cache = _changelog_cache
+    if releaser_history is None and cache is not None and cache.releaser_index is not None:
+        releaser_history = get_releaser_history(cache.releaser_index, package.name)
     if releaser_history is None:
         warning("No historical releaser history, using current maintainer name "
                 "and email for each versioned changelog entry.")
@@ -205,23 +794,22 @@ def get_changelogs(package, releaser_history=None):
     if is_debug():
         import logging
         logging.basicConfig()
-        import catkin_pkg
-        catkin_pkg.changelog.log.setLevel(logging.DEBUG)
+        # The logger of catkin_pkg.changelog, which is only imported once a changelog is parsed
+        logging.getLogger('changelog').setLevel(logging.DEBUG)
     package_path = os.path.abspath(os.path.dirname(package.filename))
     changelog_path = os.path.join(package_path, CHANGELOG_FILENAME)
     if os.path.exists(changelog_path):
-        changelog = get_changelog_from_path(changelog_path)
+        if cache is not None:
+            entries = cache.get(changelog_path)
+        else:
+            entries = parse_changelog(changelog_path)
         changelogs = []
         maintainer = (package.maintainers[0].name, package.maintainers[0].email)
-        for version, date, changes in changelog.foreach_version(reverse=True):
-            changes_str = []
-            date_str = get_rfc_2822_date(date)
-            for item in changes:
-                changes_str.extend(['  ' + i for i in to_unicode(item).splitlines()])
+        for version, date_str, changes_str in entries:
             # Each entry has (version, date, changes, releaser, releaser_email)
             releaser, email = releaser_history.get(version, maintainer)
             changelogs.append((
-                version, date_str, '\n'.join(changes_str), releaser, email
+                version, date_str, changes_str, releaser, email
             ))
         return changelogs
     else:
@@ -235,6 +823,358 @@ def missing_dep_resolver(key, peer_packages):
         return [sanitize_package_name(key)]
     return default_fallback_resolver(key, peer_packages)
 
+def get_cache_dir():
+    """Return the directory used for caches which persist between runs."""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'repo_debian_generator')
+
+
+def get_rosdep_sources_fingerprint():
+    """
+    Return a string which changes whenever the rosdep sources cache changes,
+    e.g. after running 'rosdep update'.
+    """
+    from rosdep2.sources_list import get_sources_cache_dir
+    cache_dir = get_sources_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return ''
+    stats = []
+    for name in sorted(os.listdir(cache_dir)):
+        st = os.stat(os.path.join(cache_dir, name))
+        stats.append('{0}:{1}:{2}'.format(name, st.st_size, st.st_mtime))
+    return ';'.join(stats)
+
+
+class RosdepResolutionCache(object):
+    """
+    Cache of resolved rosdep keys, keyed by (key, os_name, os_version, ros_distro).
+
+    The cache is shared by all packages of a run and can be persisted to disk
+    between runs. The persisted entries are dropped whenever the rosdep
+    sources cache changes.
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, path=None):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        # (target, key) pairs which were not resolved by rosdep and must not be persisted
+        self._transient = set()
+        self._fingerprint = get_rosdep_sources_fingerprint()
+
+    @staticmethod
+    def _target(os_name, os_version, ros_distro):
+        return ':'.join([os_name, os_version, ros_distro])
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError) as exc:
+            warning("Ignoring unreadable rosdep cache '{0}': {1}".format(self.path, exc))
+            return
+        if data.get('version') != self.FORMAT_VERSION or data.get('fingerprint') != self._fingerprint:
+            debug("rosdep sources changed since '{0}' was written, ignoring it".format(self.path))
+            return
+        with self._lock:
+            self._entries = data.get('entries', {})
+
+    def save(self):
+        if self.path is None:
+            return
+        self.refresh()
+        with self._lock:
+            entries = {}
+            for target, keys in self._entries.items():
+                entries[target] = dict(
+                    (key, resolved_key) for key, resolved_key in keys.items() if (target, key) not in self._transient)
+            data = {
+                'version': self.FORMAT_VERSION,
+                'fingerprint': self._fingerprint,
+                'entries': entries,
+            }
+        cache_dir = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def refresh(self):
+        """Drop all entries and bloom's rosdep view if the rosdep sources have changed."""
+        fingerprint = get_rosdep_sources_fingerprint()
+        if fingerprint == self._fingerprint:
+            return
+        debug("rosdep sources changed, invalidating the rosdep resolution cache")
+        invalidate_view_cache()
+        with self._lock:
+            self._entries = {}
+            self._transient = set()
+            self._fingerprint = fingerprint
+
+    def get(self, key, os_name, os_version, ros_distro):
+        with self._lock:
+            resolved_key = self._entries.get(self._target(os_name, os_version, ros_distro), {}).get(key)
+            if resolved_key is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return list(resolved_key)
+
+    def contains(self, key, os_name, os_version, ros_distro):
+        """Return whether key is cached for the target, without counting a hit or miss."""
+        with self._lock:
+            return key in self._entries.get(self._target(os_name, os_version, ros_distro), {})
+
+    def set(self, key, os_name, os_version, ros_distro, resolved_key, persist=True):
+        with self._lock:
+            target = self._target(os_name, os_version, ros_distro)
+            self._entries.setdefault(target, {})[key] = list(resolved_key)
+            if persist:
+                self._transient.discard((target, key))
+            else:
+                self._transient.add((target, key))
+
+
+_rosdep_cache = None
+
+
+def enable_rosdep_cache(path=None):
+    """
+    Enable the rosdep resolution cache for all subsequent calls to
+    resolve_dependencies, loading previously persisted entries from path.
+    """
+    global _rosdep_cache
+    _rosdep_cache = RosdepResolutionCache(path)
+    _rosdep_cache.load()
+    return _rosdep_cache
+
+
+def get_rosdep_cache():
+    return _rosdep_cache
+
+
+def get_dependency_keys(package, ros_distro):
+    """Return the names of all rosdep keys a package depends on for ros_distro."""
+    with _conditions_lock:
+        evaluate_package_conditions(package, ros_distro)
+        return [
+            dep.name for dep in (package.run_depends + package.buildtool_export_depends + package.build_depends +
+                                 package.buildtool_depends + package.test_depends + package.replaces +
+                                 package.conflicts)
+            if dep.evaluated_condition is not False]
+
+
+def prefetch_rosdep_keys(pkgs_dict, targets, concurrency=8, timeout=None, slow_threshold=1.0):
+    """
+    Resolve the rosdep keys of all packages for all (os_name, os_version,
+    ros_distro) targets up front, so resolve_dependencies answers every
+    package from the rosdep resolution cache.
+
+    The keys are deduplicated across the whole repository and resolved
+    concurrently by an asyncio engine, at most concurrency at a time. A key
+    which takes longer than timeout seconds, counted from when its lookup
+    starts, is used as is, like a key rosdep cannot resolve, and is not
+    persisted. As a lookup which timed out makes room for the next one, the
+    whole prefetch takes at most about timeout times the number of keys
+    divided by concurrency. Keys slower than slow_threshold seconds and keys
+    which timed out are reported as slow.
+    """
+    import asyncio
+
+    cache = _rosdep_cache or enable_rosdep_cache()
+    jobs = []
+    for os_name, os_version, ros_distro in targets:
+        seen = set()
+        for pkg in pkgs_dict.values():
+            for key in get_dependency_keys(pkg, ros_distro):
+                if key not in seen and not cache.contains(key, os_name, os_version, ros_distro):
+                    jobs.append((key, os_name, os_version, ros_distro))
+                seen.add(key)
+    if not jobs:
+        return {}
+
+    # Load the rosdep view of each target once, before the workers would all load it at the same time
+    from bloom.generators.common import get_view
+    for os_name, os_version, ros_distro in targets:
+        get_view(os_name, os_version, ros_distro)
+
+    durations = {}
+    timed_out = set()
+
+    def resolve_in_thread(loop, future, key, os_name, os_version, ros_distro):
+        try:
+            # The key itself is ignored, like resolve_dependencies does, so a failure is not fatal
+            result, exc = resolve_rosdep_key(key, os_name, os_version, ros_distro, [key], True), None
+        except Exception as e:
+            result, exc = None, e
+
+        def done():
+            if not future.done():
+                if exc is not None:
+                    future.set_exception(exc)
+                else:
+                    future.set_result(result)
+        try:
+            loop.call_soon_threadsafe(done)
+        except RuntimeError:
+            # The lookup timed out and the loop is already closed
+            pass
+
+    async def resolve(semaphore, target):
+        key, os_name, os_version, ros_distro = target
+        async with semaphore:
+            loop = asyncio.get_event_loop()
+            future = loop.create_future()
+            # Every key gets a thread of its own as soon as it gets a slot. A
+            # lookup which timed out gives up its slot, so its thread, which
+            # cannot be interrupted, is replaced instead of blocking the keys
+            # after it, which therefore wait for at most the timeouts of the
+            # keys before them. The threads are daemons, a hanging lookup does
+            # not keep the process from exiting.
+            thread = threading.Thread(target=resolve_in_thread, args=(loop, future) + target,
+                                      name='rosdep-{0}'.format(key))
+            thread.daemon = True
+            start = time.time()
+            thread.start()
+            try:
+                resolved_key = (await asyncio.wait_for(future, timeout))[0]
+                persist = True
+            except asyncio.TimeoutError:
+                warning("Resolving rosdep key '{0}' for {1}:{2} timed out after {3} seconds, using it as is"
+                        .format(key, os_name, os_version, timeout))
+                resolved_key, persist = None, False
+                timed_out.add(target)
+            durations[target] = time.time() - start
+        # If resolve key fails use the key as the resolved key
+        cache.set(key, os_name, os_version, ros_distro, resolved_key or [key], persist)
+
+    async def resolve_all():
+        semaphore = asyncio.Semaphore(concurrency)
+        await asyncio.gather(*[resolve(semaphore, target) for target in jobs])
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(resolve_all())
+    finally:
+        loop.close()
+
+    # Keys which timed out are slow, whatever the timeout
+    slow = sorted(((t, d) for t, d in durations.items() if d >= slow_threshold or t in timed_out),
+                  key=lambda x: -x[1])
+    for target, duration in slow:
+        key, os_name, os_version, _ = target
+        info("Slow rosdep key '{0}' for {1}:{2}: {3:.2f} s{4}".format(
+            key, os_name, os_version, duration, ' (timed out)' if target in timed_out else ''))
+    info("Resolved {0} rosdep keys for {1} target(s), {2} of them slow".format(len(jobs), len(targets), len(slow)))
+    return durations
+
+
+class RosdepSnapshot(object):
+    """
+    Pre-resolved rosdep keys of a repository for a set of targets, loaded
+    from a snapshot file written by write_rosdep_snapshot.
+
+    A snapshot answers resolve_dependencies without loading rosdep, and
+    provides the context the package conditions are evaluated in without
+    loading rosdistro, so runs using it are reproducible and work offline.
+    """
+
+    FORMAT_VERSION = 2
+
+    def __init__(self, targets=None, path=None, contexts=None):
+        self.path = path
+        # {'os_name:os_version:ros_distro': {key: resolved_key}}
+        self.targets = targets or {}
+        # {ros_distro: {'ROS_VERSION': ..., 'ROS_DISTRO': ..., 'ROS_PYTHON_VERSION': ...}}
+        self.contexts = contexts or {}
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError) as exc:
+            error("Could not read rosdep snapshot '{0}': {1}".format(path, exc), exit=True)
+        if data.get('version') != cls.FORMAT_VERSION:
+            error("Unsupported rosdep snapshot version '{0}' in '{1}', please regenerate it"
+                  .format(data.get('version'), path), exit=True)
+        return cls(data['targets'], path, data['contexts'])
+
+    def save(self, path):
+        data = {'version': self.FORMAT_VERSION, 'targets': self.targets, 'contexts': self.contexts}
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write('\n')
+        os.rename(tmp_path, path)
+        self.path = path
+
+    def digest(self):
+        return hashlib.sha1(json.dumps([self.targets, self.contexts], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_targets(self):
+        return [tuple(target.split(':')) for target in sorted(self.targets)]
+
+    def get(self, key, os_name, os_version, ros_distro):
+        target = RosdepResolutionCache._target(os_name, os_version, ros_distro)
+        if target not in self.targets:
+            error("The rosdep snapshot '{0}' has no entries for {1}, please regenerate it"
+                  .format(self.path, target), exit=True)
+        resolved_key = self.targets[target].get(key)
+        if resolved_key is None:
+            error("The rosdep key '{0}' is missing from the rosdep snapshot '{1}' for {2}, please regenerate it"
+                  .format(key, self.path, target), exit=True)
+        return list(resolved_key)
+
+    def get_context(self, ros_distro):
+        context = self.contexts.get(ros_distro)
+        if context is None:
+            error("The rosdep snapshot '{0}' has no condition context for {1}, please regenerate it"
+                  .format(self.path, ros_distro), exit=True)
+        return dict(context)
+
+
+_rosdep_snapshot = None
+
+
+def enable_rosdep_snapshot(path):
+    """Answer all subsequent calls to resolve_dependencies from the rosdep snapshot in path."""
+    global _rosdep_snapshot
+    _rosdep_snapshot = RosdepSnapshot.load(path)
+    return _rosdep_snapshot
+
+
+def get_rosdep_snapshot():
+    return _rosdep_snapshot
+
+
+def write_rosdep_snapshot(path, pkgs_dict, targets, concurrency=8):
+    """
+    Resolve every rosdep key used by the packages for each target and write
+    them to a rosdep snapshot file in path.
+    """
+    # No timeout, a key which is used as is because it timed out must not end up in the snapshot
+    prefetch_rosdep_keys(pkgs_dict, targets, max(concurrency, 1))
+    cache = _rosdep_cache
+    snapshot = RosdepSnapshot()
+    for os_name, os_version, ros_distro in targets:
+        snapshot.contexts[ros_distro] = package_conditional_context(ros_distro)
+        entries = snapshot.targets.setdefault(RosdepResolutionCache._target(os_name, os_version, ros_distro), {})
+        for pkg in pkgs_dict.values():
+            for key in get_dependency_keys(pkg, ros_distro):
+                entries[key] = cache.get(key, os_name, os_version, ros_distro)
+    snapshot.save(path)
+    return snapshot
+
+
 def resolve_dependencies(
     keys,
     os_name,
@@ -248,7 +1188,17 @@ def resolve_dependencies(
     resolved_keys = {}
     keys = [k.name for k in keys]
     peer_packages = keys # This was added so resolve_rosdep_key never fails
+    cache = _rosdep_cache
     for key in keys:
+        if _rosdep_snapshot is not None:
+            resolved_keys[key] = _rosdep_snapshot.get(key, os_name, os_version, ros_distro)
+            continue
+        if cache is not None:
+            resolved_key = cache.get(key, os_name, os_version, ros_distro)
+            if resolved_key is not None:
+                resolved_keys[key] = resolved_key
+                continue
+
         resolved_key, installer_key, default_installer_key = \
             resolve_rosdep_key(key, os_name, os_version, ros_distro,
                                peer_packages, retry=True)
@@ -257,51 +1207,201 @@ def resolve_dependencies(
         if resolved_key is None:
             resolved_key = [key]
 
+        if cache is not None:
+            cache.set(key, os_name, os_version, ros_distro, resolved_key)
         resolved_keys[key] = resolved_key
 
     return resolved_keys
 
 
-def convertToUnicode(obj):
-    if sys.version_info.major == 2:
-        if isinstance(obj, str):
-            return unicode(obj.decode('utf8'))
-        elif isinstance(obj, unicode):
-            return obj
-    else:
-        if isinstance(obj, bytes):
-            return str(obj.decode('utf8'))
-        elif isinstance(obj, str):
-            return obj
-    if isinstance(obj, list):
-        for i, val in enumerate(obj):
-            obj[i] = convertToUnicode(val)
-        return obj
-    elif isinstance(obj, type(None)):
-        return None
-    elif isinstance(obj, tuple):
-        obj_tmp = list(obj)
-        for i, val in enumerate(obj_tmp):
-            obj_tmp[i] = convertToUnicode(obj_tmp[i])
-        return tuple(obj_tmp)
-    elif isinstance(obj, int):
-        return obj
-    raise RuntimeError('need to deal with type %s' % (str(type(obj))))
+def normalize_text(value):
+    """
+    Return value with every byte string in it, also inside of lists and
+    tuples, decoded as UTF-8 text.
 
+    Lists and tuples which only contain text are returned as they are, the
+    others are copied, so the value passed in is never modified.
+    """
+    if isinstance(value, bytes) and not isinstance(value, text_type):
+        return value.decode('utf-8')
+    if isinstance(value, (list, tuple)):
+        normalized = [normalize_text(item) for item in value]
+        if all(a is b for a, b in zip(normalized, value)):
+            return value
+        return type(value)(normalized)
+    return value
 
-def generate_substitutions_from_package(
+
+TEXT = (text_type,)
+OPTIONAL_TEXT = (text_type, type(None))
+SEQUENCE = (list, tuple)
+
+
+class Substitutions(Mapping):
+    """
+    A typed record of the substitutions for the templates, which is a read
+    only mapping of the substitution names to their values.
+
+    The fields are listed in FIELDS as (name, types, required) and each one
+    is stored in a slot. Their text is normalized once, when the record is
+    constructed, and an unknown or missing field or a value of the wrong type
+    is reported with the name of the package it belongs to.
+    """
+
+    __slots__ = ()
+    FIELDS = ()
+
+    def __init__(self, base=None, **fields):
+        """
+        :param base: record whose fields are copied as they are, e.g. the
+            common substitutions of a package, or None
+        :param fields: the other fields, overriding those of base
+        """
+        for name, types, required in self.FIELDS:
+            if name in fields:
+                value = normalize_text(fields.pop(name))
+                if not isinstance(value, types):
+                    self._fail("field '{0}' must be of type {1}, got {2!r}".format(
+                        name, ' or '.join(t.__name__ for t in types), value))
+            elif base is not None and name in base:
+                value = base[name]
+            elif required:
+                self._fail("field '{0}' is missing".format(name))
+            else:
+                continue
+            setattr(self, name, value)
+        if fields:
+            self._fail("unknown field(s) {0}".format(', '.join(sorted(fields))))
+
+    def _fail(self, message):
+        owner = getattr(self, 'Name', None) or getattr(self, 'Package', None)
+        raise ValueError("Invalid {0}{1}: {2}".format(
+            type(self).__name__, " of '{0}'".format(owner) if owner else '', message))
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except (AttributeError, TypeError):
+            raise KeyError(name)
+
+    def __iter__(self):
+        for name, _, _ in self.FIELDS:
+            if hasattr(self, name):
+                yield name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return '{0}({1})'.format(type(self).__name__, ', '.join(
+            '{0}={1!r}'.format(name, value) for name, value in self.items()))
+
+    def __getstate__(self):
+        return dict(self.items())
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+class CommonSubstitutions(Substitutions):
+    """
+    The substitutions of a package which do not depend on the target OS or
+    ROS distribution, see generate_common_substitutions.
+    """
+
+    FIELDS = (
+        ('Name', TEXT, True),
+        ('Version', TEXT, True),
+        ('Description', TEXT, True),
+        ('Homepage', TEXT, True),
+        ('DebianInc', TEXT, True),
+        ('format', TEXT, True),
+        ('Package', TEXT, True),
+        ('InstallationPrefix', TEXT, True),
+        ('BuildType', TEXT, True),
+        ('pass_install_scripts', (bool,), False),
+        ('Date', TEXT, True),
+        ('YYYY', TEXT, True),
+        ('Maintainer', TEXT, True),
+        ('Maintainers', TEXT, True),
+        ('MaintainerList', SEQUENCE, True),
+        # Each entry as (version, date, changes, releaser, email)
+        ('changelogs', SEQUENCE, True),
+        ('PackagePath', TEXT, True),
+        # Each license as (name, license file or None, hash of the license file or None)
+        ('Licenses', SEQUENCE, True),
+    )
+    __slots__ = tuple(name for name, _, _ in FIELDS)
+
+
+class PackageSubstitutions(Substitutions):
+    """
+    The substitutions of a package for one target OS and ROS distribution,
+    see generate_distro_substitutions.
+    """
+
+    FIELDS = CommonSubstitutions.FIELDS + (
+        ('BuildDependencyNames', SEQUENCE, True),
+        ('Depends', SEQUENCE, True),
+        ('BuildDepends', SEQUENCE, True),
+        ('Replaces', SEQUENCE, True),
+        ('Conflicts', SEQUENCE, True),
+        ('Distribution', TEXT, True),
+        ('debhelper_version', (int,), True),
+    )
+    __slots__ = tuple(name for name, _, _ in FIELDS)
+
+
+class RepoSubstitutions(Substitutions):
+    """
+    The substitutions of the repository wide source package, see
+    RepoHeaderBuilder.
+    """
+
+    FIELDS = (
+        ('Package', TEXT, True),
+        ('DebianInc', TEXT, True),
+        ('format', TEXT, True),
+        ('InstallationPrefix', TEXT, True),
+        ('Maintainer', TEXT, True),
+        ('Maintainers', TEXT, True),
+        ('MaintainerList', SEQUENCE, True),
+        ('BuildDepends', SEQUENCE, True),
+        ('BuildType', TEXT, True),
+        ('BuildTypes', SEQUENCE, True),
+        ('PythonPackages', SEQUENCE, True),
+        ('Packages', SEQUENCE, True),
+        ('BuildWaves', SEQUENCE, True),
+        # Each package as (Debian package name, version) whose version differs from the one of the source package
+        ('BinaryVersions', SEQUENCE, True),
+        # Debian package names of the packages which are built but not published again
+        ('UnchangedPackages', SEQUENCE, True),
+        # Folder the debian folder is placed in
+        ('SourceRoot', TEXT, True),
+        ('CMakeArgs', SEQUENCE, True),
+        ('CMakeBuildSystem', TEXT, True),
+        ('CompilerCache', OPTIONAL_TEXT, True),
+        ('Homepage', TEXT, True),
+        ('Licenses', SEQUENCE, True),
+        ('debhelper_version', (int,), True),
+        ('changelogs', SEQUENCE, True),
+        ('Distribution', TEXT, True),
+    )
+    __slots__ = tuple(name for name, _, _ in FIELDS)
+
+
+def generate_common_substitutions(
     package,
-    os_name,
-    os_version,
-    ros_distro,
     installation_prefix='/usr',
     deb_inc=0,
-    peer_packages=None,
     releaser_history=None,
-    fallback_resolver=None,
     native=False
 ):
-    peer_packages = peer_packages or []
+    """
+    Generate the substitutions of a package which do not depend on the target
+    OS or ROS distribution.
+    """
     data = {}
     # Name, Version, Description
     data['Name'] = package.name
@@ -321,38 +1421,9 @@ def generate_substitutions_from_package(
     data['Package'] = sanitize_package_name(package.name)
     # Installation prefix
     data['InstallationPrefix'] = installation_prefix
-    # Resolve dependencies
-    evaluate_package_conditions(package, ros_distro)
-    depends = [
-        dep for dep in (package.run_depends + package.buildtool_export_depends)
-        if dep.evaluated_condition is not False]
-    build_depends = [
-        dep for dep in (package.build_depends + package.buildtool_depends + package.test_depends)
-        if dep.evaluated_condition is not False]
-
-    unresolved_keys = [
-        dep for dep in (depends + build_depends + package.replaces + package.conflicts)
-        if dep.evaluated_condition is not False]
-    # The installer key is not considered here, but it is checked when the keys are checked before this
-    resolved_deps = resolve_dependencies(unresolved_keys, os_name,
-                                         os_version, ros_distro,
-                                         peer_packages + [d.name for d in package.replaces + package.conflicts],
-                                         fallback_resolver)
-    data['Depends'] = sorted(
-        set(format_depends(depends, resolved_deps))
-    )
-    data['BuildDepends'] = sorted(
-        set(format_depends(build_depends, resolved_deps))
-    )
-    data['Replaces'] = sorted(
-        set(format_depends(package.replaces, resolved_deps))
-    )
-    data['Conflicts'] = sorted(
-        set(format_depends(package.conflicts, resolved_deps))
-    )
-
     # Build-type specific substitutions.
     build_type = package.get_build_type()
+    data['BuildType'] = build_type
     if build_type == 'catkin':
         pass
     elif build_type == 'cmake':
@@ -377,9 +1448,8 @@ def generate_substitutions_from_package(
             "Build type '{}' is not supported by this version of bloom.".
             format(build_type), exit=True)
 
-    # Set the distribution
-    data['Distribution'] = os_version
     # Use the time stamp to set the date strings
+    from dateutil import tz
     stamp = datetime.datetime.now(tz.tzlocal())
     data['Date'] = stamp.strftime('%a, %d %b %Y %T %z')
     data['YYYY'] = stamp.strftime('%Y')
@@ -389,8 +1459,10 @@ def generate_substitutions_from_package(
         maintainers.append(str(m))
     data['Maintainer'] = maintainers[0]
     data['Maintainers'] = ', '.join(maintainers)
+    data['MaintainerList'] = maintainers
     # Changelog
-    changelogs = get_changelogs(package, releaser_history)
+    with timed('changelog parsing', package.name):
+        changelogs = get_changelogs(package, releaser_history)
     if changelogs and package.version not in [x[0] for x in changelogs]:
         warning("")
         warning("A CHANGELOG.rst was found, but no changelog for this version was found.")
@@ -430,157 +1502,1508 @@ def generate_substitutions_from_package(
         if not maybe_continue('n', 'Continue anyways'):
             sys.exit("User quit.")
     data['changelogs'] = changelogs
+    # Copyright
+    # Only the hashes of the license files are kept, their texts are streamed
+    # into debian/copyright by iter_debian_tree
+    data['PackagePath'] = os.path.abspath(os.path.dirname(package.filename))
+    licenses = []
+    with timed('license reading', package.name):
+        for l in package.licenses:
+            license_file = license_digest = None
+            if hasattr(l, 'file') and l.file is not None:
+                license_file = os.path.join(data['PackagePath'], l.file)
+                if not os.path.exists(license_file):
+                    error("License file '{}' is not found.".
+                          format(license_file), exit=True)
+                license_digest = _hash_file(license_file)
+            licenses.append((str(l), license_file, license_digest))
+    data['Licenses'] = licenses
+
+    return CommonSubstitutions(**data)
+
+
+_conditions_lock = threading.Lock()
+
+
+def generate_distro_substitutions(
+    package,
+    common,
+    os_name,
+    os_version,
+    ros_distro,
+    peer_packages=None,
+    fallback_resolver=None
+):
+    """
+    Generate the substitutions of a package for one target OS and ROS
+    distribution, extending the substitutions from generate_common_substitutions.
+    """
+    peer_packages = peer_packages or []
+    data = {}
+    # Resolve dependencies
+    # Evaluating the conditions modifies the dependencies of the package, so
+    # it must not interleave with the evaluation for another target
+    with _conditions_lock:
+        evaluate_package_conditions(package, ros_distro)
+        depends = [
+            dep for dep in (package.run_depends + package.buildtool_export_depends)
+            if dep.evaluated_condition is not False]
+        build_depends = [
+            dep for dep in (package.build_depends + package.buildtool_depends + package.test_depends)
+            if dep.evaluated_condition is not False]
+
+        unresolved_keys = [
+            dep for dep in (depends + build_depends + package.replaces + package.conflicts)
+            if dep.evaluated_condition is not False]
+        # Everything which has to be built before this package, used to order the packages of the repository
+        data['BuildDependencyNames'] = sorted(set(
+            dep.name for dep in (package.build_depends + package.buildtool_depends +
+                                 package.build_export_depends + package.buildtool_export_depends)
+            if dep.evaluated_condition is not False))
+    # The installer key is not considered here, but it is checked when the keys are checked before this
+    with timed('rosdep resolution', package.name):
+        resolved_deps = resolve_dependencies(unresolved_keys, os_name,
+                                             os_version, ros_distro,
+                                             peer_packages + [d.name for d in package.replaces + package.conflicts],
+                                             fallback_resolver)
+    data['Depends'] = sorted(
+        set(format_depends(depends, resolved_deps))
+    )
+    data['BuildDepends'] = sorted(
+        set(format_depends(build_depends, resolved_deps))
+    )
+    data['Replaces'] = sorted(
+        set(format_depends(package.replaces, resolved_deps))
+    )
+    data['Conflicts'] = sorted(
+        set(format_depends(package.conflicts, resolved_deps))
+    )
+
+    # Set the distribution
+    data['Distribution'] = os_version
     # Use debhelper version 7 for oneric, otherwise 9
     data['debhelper_version'] = 7 if os_version in ['oneiric'] else 9
+    subs = PackageSubstitutions(common, **data)
     # Summarize dependencies
-    summarize_dependency_mapping(data, depends, build_depends, resolved_deps)
-    # Copyright
-    licenses = []
-    separator = '\n' + '=' * 80 + '\n\n'
-    for l in package.licenses:
-        if hasattr(l, 'file') and l.file is not None:
-            license_file = os.path.join(os.path.dirname(package.filename), l.file)
-            if not os.path.exists(license_file):
-                error("License file '{}' is not found.".
-                      format(license_file), exit=True)
-            license_text = open(license_file, 'r').read()
-            if not license_text.endswith('\n'):
-                license_text += '\n'
-            licenses.append(license_text)
-    data['Copyright'] = separator.join(licenses)
+    summarize_dependency_mapping(subs, depends, build_depends, resolved_deps)
+
+    return subs
+
 
-    for item in data.items():
-        data[item[0]] = convertToUnicode(item[1])
+def generate_substitutions_from_package(
+    package,
+    os_name,
+    os_version,
+    ros_distro,
+    installation_prefix='/usr',
+    deb_inc=0,
+    peer_packages=None,
+    releaser_history=None,
+    fallback_resolver=None,
+    native=False
+):
+    common = generate_common_substitutions(package, installation_prefix, deb_inc, releaser_history, native)
+    return generate_distro_substitutions(package, common, os_name, os_version, ros_distro, peer_packages,
+                                         fallback_resolver)
 
-    return data
 
+def generate_package_substitutions(pkgs_dict, get_subs_fn, os_name, os_version, ros_distro, install_prefix,
+                                   native=False, jobs=1):
+    """
+    Call get_subs_fn for every package in pkgs_dict, using up to jobs worker
+    threads.
 
-def merge_packages(pkgs_dict, get_subs_fn, os_name, os_version, ros_distro, install_prefix, native=False):
-    all_subs = {}
-    for path, pkg in pkgs_dict.items():
-        try:
-            subs = get_subs_fn(pkg, os_name, os_version, ros_distro, install_prefix, native)
-            all_subs[subs['Name']] = subs
-        except Exception as exc:
-            debug(traceback.format_exc())
-            error(type(exc).__name__ + ": " + str(exc), exit=True)
-        except (KeyboardInterrupt, EOFError):
-            sys.exit(1)
+    The substitutions are returned as a list in the iteration order of
+    pkgs_dict, independent of the order in which the workers finish. On the
+    first failure no further packages are started and the error is reported
+    together with the name of the package which caused it.
+    """
+    pkgs = list(pkgs_dict.values())
 
-    repo_header = {}
-    cnt = 0
-    for pkg, sub in all_subs.items():
-        try:
-            if (0 == cnt):
-                repo_header['Package'] = convertToUnicode(sanitize_package_name('tesseract_core'))
-                repo_header['DebianInc'] = sub['DebianInc']
-                repo_header['format'] = sub['format']
-                repo_header['InstallationPrefix'] = sub['InstallationPrefix']
-                repo_header['Maintainer'] = sub['Maintainers'][0]
-                repo_header['Maintainers'] = sub['Maintainers']
-                repo_header['BuildDepends'] = sub['BuildDepends']
-                repo_header['Homepage'] = sub['Homepage']
-                repo_header['Copyright'] = sub['Copyright']
-                repo_header['debhelper_version'] = sub['debhelper_version']
-                repo_header['changelogs'] = sub['changelogs']
-                repo_header['Distribution'] = sub['Distribution']
-            else:
-                repo_header['Maintainers'].join(', '.join(sub['Maintainers']))
-                repo_header['BuildDepends'].extend(sub['BuildDepends'])
-                repo_header['Copyright'].join(sub['Copyright'])
+    def get_subs(pkg):
+        with timed('package substitutions', pkg.name):
+            return get_subs_fn(pkg, os_name, os_version, ros_distro, install_prefix, native)
 
-            cnt = cnt + 1
-        except Exception as exc:
-            debug(traceback.format_exc())
-            error(type(exc).__name__ + ": " + str(exc), exit=True)
-        except (KeyboardInterrupt, EOFError):
+    def report_failure(pkg, exc):
+        if isinstance(exc, (KeyboardInterrupt, EOFError)):
             sys.exit(1)
+        if isinstance(exc, SystemExit) and not isinstance(exc.code, str):
+            error("Failed to generate substitutions for package '{0}'".format(pkg.name), exit=True)
+        error("Failed to generate substitutions for package '{0}': {1}: {2}"
+              .format(pkg.name, type(exc).__name__, str(exc)), exit=True)
+
+    results = [None] * len(pkgs)
+    if jobs is None or jobs <= 1 or len(pkgs) <= 1:
+        for index, pkg in enumerate(pkgs):
+            try:
+                results[index] = get_subs(pkg)
+            except (Exception, SystemExit, KeyboardInterrupt, EOFError) as exc:
+                debug(traceback.format_exc())
+                report_failure(pkg, exc)
+        return results
+
+    failure = None
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = dict((executor.submit(get_subs, pkg), index) for index, pkg in enumerate(pkgs))
+        try:
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    results[index] = future.result()
+                except (Exception, SystemExit, EOFError) as exc:
+                    debug(traceback.format_exc())
+                    failure = (pkgs[index], exc)
+                    break
+        except KeyboardInterrupt as exc:
+            failure = (None, exc)
+        if failure is not None:
+            # Do not start any of the packages which are still queued
+            for future in futures:
+                future.cancel()
+    if failure is not None:
+        report_failure(*failure)
+    return results
+
+
+# "name" or "name (op version)", as produced by format_depends
+DEPENDS_REGEX = re.compile(r'^(?P<name>[^\s(]+)\s*(?:\((?P<constraint>[^)]*)\))?$')
+
+
+class RepoHeaderBuilder(object):
+    """
+    Aggregates the substitutions of all packages of a repository into the
+    substitutions of the repository wide source package, in one pass.
+
+    Build dependencies are deduplicated by Debian package name, keeping the
+    version constraints if any package specified one, and dependencies on
+    packages of the repository itself are dropped. Maintainers and license
+    files are deduplicated keeping the order in which they were first seen.
+    """
+
+    def __init__(self, package_names):
+        self._repo_packages = set(sanitize_package_name(name) for name in package_names)
+        self._first = None
+        # Debian package name -> OrderedDict of its version constraints (None when unconstrained)
+        self._build_depends = collections.OrderedDict()
+        self._maintainers = collections.OrderedDict()
+        self._packages = []
+        # License file hash -> (name, path, hash)
+        self._licenses = collections.OrderedDict()
+
+    def add(self, subs):
+        if self._first is None:
+            self._first = subs
+        self._packages.append(subs)
+        for depend in subs['BuildDepends']:
+            match = DEPENDS_REGEX.match(depend)
+            name, constraint = (match.group('name'), match.group('constraint')) if match else (depend, None)
+            if sanitize_package_name(name) in self._repo_packages:
+                continue
+            self._build_depends.setdefault(name, collections.OrderedDict())[constraint] = None
+        for maintainer in subs.get('MaintainerList') or [subs['Maintainer']]:
+            self._maintainers[maintainer] = None
+        for license in subs['Licenses']:
+            self._licenses.setdefault(license[2] or license[0], license)
+
+    def build_depends(self):
+        build_depends = []
+        for name, constraints in self._build_depends.items():
+            constrained = [c for c in constraints if c is not None]
+            if not constrained:
+                build_depends.append(name)
+            # An unconstrained duplicate adds nothing to a constrained dependency
+            for constraint in constrained:
+                build_depends.append(u'{0} ({1})'.format(name, constraint))
+        return build_depends
+
+    def build(self, package, build_waves=None, cmake_subs=None, source_root=None):
+        """
+        :param source_root: folder the debian folder is placed in, which the
+            folders of the packages in the rules are relative to, the current
+            directory by default
+        """
+        first = self._first
+        build_depends = self.build_depends()
+        cmake_subs = cmake_subs or generate_cmake_substitutions()
+        build_types = [subs['BuildType'] for subs in self._packages]
+        subs_by_name = dict((subs['Name'], subs) for subs in self._packages)
+        root = os.path.abspath(source_root or os.curdir)
+        folders = dict((subs['Name'], get_source_folder(subs, root)) for subs in self._packages)
+        python_packages = [
+            (folders[subs['Name']], subs['pass_install_scripts'])
+            for subs in self._packages if subs['BuildType'] == 'ament_python']
+        if python_packages:
+            build_depends.extend(d for d in PYTHON_BUILD_DEPENDS if d not in build_depends)
+        if any(build_type in CMAKE_BUILD_TYPES for build_type in build_types):
+            build_depends.extend(d for d in cmake_subs['CMakeBuildDepends'] if d not in build_depends)
+        return RepoSubstitutions(
+            Package=package,
+            DebianInc=first['DebianInc'],
+            format=first['format'],
+            InstallationPrefix=first['InstallationPrefix'],
+            Maintainer=first['Maintainer'],
+            Maintainers=u', '.join(self._maintainers),
+            MaintainerList=list(self._maintainers),
+            BuildDepends=build_depends,
+            BuildType=select_repo_build_type(build_types),
+            BuildTypes=sorted(set(build_types), key=build_types.index),
+            PythonPackages=python_packages,
+            # Each package as (name, Debian package name, folder, build type, pass_install_scripts), the rules
+            # install every package into debian/tmp/<Debian package name> for its debian/<package>.install
+            Packages=[
+                (subs['Name'], subs['Package'], folders[subs['Name']], subs['BuildType'],
+                 subs.get('pass_install_scripts', False)) for subs in self._packages],
+            # Each package as (name, Debian package name, folder, build type, dependencies, pass_install_scripts)
+            BuildWaves=[
+                [(name, subs_by_name[name]['Package'], folders[name],
+                  subs_by_name[name]['BuildType'], depends, subs_by_name[name].get('pass_install_scripts', False))
+                 for name, depends in wave]
+                for wave in build_waves or []],
+            BinaryVersions=[],
+            UnchangedPackages=[],
+            SourceRoot=root,
+            CMakeArgs=cmake_subs['CMakeArgs'],
+            CMakeBuildSystem=cmake_subs['CMakeBuildSystem'],
+            CompilerCache=cmake_subs['CompilerCache'],
+            Homepage=first['Homepage'],
+            Licenses=list(self._licenses.values()),
+            debhelper_version=first['debhelper_version'],
+            changelogs=merge_changelogs(
+                [(subs['Name'], subs['changelogs']) for subs in self._packages],
+                _changelog_cache.depth if _changelog_cache is not None else None),
+            Distribution=first['Distribution'],
+        )
+
+
+def merge_changelogs(packages_changelogs, depth=None):
+    """
+    Merge the changelogs of the packages of a repository into the changelog
+    of the repository, newest version first.
+
+    The changelogs, each newest first, are merged lazily with a k-way merge,
+    so with depth only the entries of the newest depth versions are visited.
+    The entries of all packages for the same version are combined into one
+    entry, listing the changes of each package under its name when the
+    repository has more than one package, with the newest date and its releaser.
+
+    :param packages_changelogs: list of (package name, changelogs) with the
+        (version, date, changes, releaser, email) entries of each package
+    :returns: list of (version, date, changes, releaser, email) entries
+    """
+    def entries(name, changelogs):
+        for entry in changelogs:
+            yield parse_version(entry[0]), name, entry
+
+    merged = heapq.merge(*[entries(name, changelogs) for name, changelogs in packages_changelogs],
+                         key=lambda item: item[0], reverse=True)
+    label = len(packages_changelogs) > 1
+    changelogs = []
+    for _, group in itertools.islice(itertools.groupby(merged, key=lambda item: item[0]), depth):
+        group = sorted((name, entry) for _, name, entry in group)
+        # The newest date of the entries, with its releaser
+        version, date, _, releaser, email_address = max(
+            (entry for _, entry in group), key=lambda entry: email.utils.mktime_tz(email.utils.parsedate_tz(entry[1])))
+        changes = '\n\n'.join(
+            u'  [ {0} ]\n{1}'.format(name, entry[2]) if label else entry[2] for name, entry in group)
+        changelogs.append((group[0][1][0], date, changes, releaser, email_address))
+    return changelogs
+
+
+def _find_cycle(depends):
+    """Return a dependency cycle of the packages in depends, which maps names to sets of names."""
+    path = []
+    on_path = set()
+    visited = set()
+
+    def visit(name):
+        path.append(name)
+        on_path.add(name)
+        for dep in sorted(depends[name]):
+            if dep in on_path:
+                return path[path.index(dep):] + [dep]
+            if dep not in visited:
+                cycle = visit(dep)
+                if cycle:
+                    return cycle
+        visited.add(name)
+        on_path.discard(path.pop())
+        return None
 
-    # Remove build depends in this repository
-    repo_header['BuildDepends'] = [x for x in repo_header['BuildDepends'] if x not in all_subs.keys()]
-    # Remove duplicates
-    repo_header['BuildDepends'] = list(dict.fromkeys(repo_header['BuildDepends']))
-    # TODO Remove Duplicates from repo_header['Maintainers']
+    for name in sorted(depends):
+        if name not in visited:
+            cycle = visit(name)
+            if cycle:
+                return cycle
+    return []
 
+
+def compute_build_waves(packages_subs):
+    """
+    Order the packages with the given substitutions by their build
+    dependencies on each other, using Kahn's algorithm.
+
+    :returns: list of waves, each a list of (name, sorted names of the
+        packages of the repository it depends on), in which every package only
+        depends on packages of the previous waves
+    :raises: RuntimeError if the dependencies contain a cycle
+    """
+    names = [subs['Name'] for subs in packages_subs]
+    depends = collections.OrderedDict(
+        (subs['Name'], set(d for d in subs['BuildDependencyNames'] if d in names and d != subs['Name']))
+        for subs in packages_subs)
+    remaining = collections.OrderedDict((name, set(deps)) for name, deps in depends.items())
+    waves = []
+    while remaining:
+        wave = [name for name, deps in remaining.items() if not deps]
+        if not wave:
+            raise RuntimeError("The packages have a circular build dependency: {0}".format(
+                ' -> '.join(_find_cycle(remaining))))
+        waves.append([(name, sorted(depends[name])) for name in wave])
+        for name in wave:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(wave)
+    return waves
+
+
+def select_repo_build_type(build_types):
+    """
+    Return the build type whose templates are used for the repository, given
+    the build type of each of its packages.
+
+    The packages of all CMake based build types are configured in a single
+    pass from the repository root, so the most used of them is picked; only
+    a repository of Python packages alone uses the ament_python templates.
+    """
+    counts = collections.OrderedDict()
+    for build_type in build_types:
+        counts[build_type] = counts.get(build_type, 0) + 1
+    cmake_build_types = [b for b in counts if b in CMAKE_BUILD_TYPES]
+    if not cmake_build_types:
+        return 'ament_python' if counts else 'cmake'
+    return max(cmake_build_types, key=lambda b: counts[b])
+
+
+def get_repo_build_type(pkgs_dict):
+    """Return the build type whose templates are used for the packages in pkgs_dict."""
+    return select_repo_build_type([pkg.get_build_type() for pkg in pkgs_dict.values()])
+
+
+def get_source_folder(subs, source_root):
+    """
+    Return the folder of the package with the given substitutions relative
+    to source_root, the folder the debian folder is placed in.
+    """
+    folder = os.path.relpath(subs['PackagePath'], source_root)
+    if folder == os.pardir or folder.startswith(os.pardir + os.sep):
+        error("The package '{0}' in '{1}' is not inside of the source tree '{2}' the debian folder is placed in"
+              .format(subs['Name'], subs['PackagePath'], source_root), exit=True)
+    return folder.replace(os.sep, '/')
+
+
+def generate_cmake_substitutions(compiler_cache=None, unity_build=False, build_type=None, ninja=False):
+    """
+    Generate the substitutions which configure how the rules build the CMake
+    packages of the repository.
+
+    :param compiler_cache: one of COMPILER_CACHES used as the compiler launcher, or None
+    :param unity_build: whether to build the CMake targets as unity builds
+    :param build_type: CMAKE_BUILD_TYPE, e.g. 'RelWithDebInfo', or None for the debhelper default
+    :param ninja: whether to use the Ninja generator instead of Makefiles
+    """
+    cmake_args = []
+    build_depends = []
+    if compiler_cache is not None:
+        if compiler_cache not in COMPILER_CACHES:
+            error("Unknown compiler cache '{0}', expected one of: {1}"
+                  .format(compiler_cache, ', '.join(COMPILER_CACHES)), exit=True)
+        cmake_args.extend('-DCMAKE_{0}_COMPILER_LAUNCHER={1}'.format(language, compiler_cache)
+                          for language in ('C', 'CXX'))
+        build_depends.append(compiler_cache)
+    if unity_build:
+        cmake_args.append('-DCMAKE_UNITY_BUILD=ON')
+    if build_type:
+        cmake_args.append('-DCMAKE_BUILD_TYPE={0}'.format(build_type))
+    if ninja:
+        build_depends.append('ninja-build')
+    return {
+        'CMakeArgs': cmake_args,
+        'CMakeBuildSystem': 'cmake+ninja' if ninja else 'cmake',
+        'CompilerCache': compiler_cache,
+        'CMakeBuildDepends': build_depends,
+    }
+
+
+def merge_packages(pkgs_dict, get_subs_fn, os_name, os_version, ros_distro, install_prefix, native=False, jobs=1,
+                   topological=False, cmake_options=None, source_package=DEFAULT_SOURCE_PACKAGE, source_root=None):
+    all_subs = collections.OrderedDict()
+    for subs in generate_package_substitutions(pkgs_dict, get_subs_fn, os_name, os_version, ros_distro,
+                                               install_prefix, native, jobs):
+        all_subs[subs['Name']] = subs
+    return add_repo_header(all_subs, topological, cmake_options, source_package, source_root)
+
+
+def add_repo_header(all_subs, topological=False, cmake_options=None, source_package=DEFAULT_SOURCE_PACKAGE,
+                    source_root=None):
+    """
+    Add the substitutions of the repository wide source package named source_package as the last entry of
+    the package substitutions in all_subs, see split_repo_header.
+
+    With topological, the rules build the packages one by one in the order of their build dependencies,
+    which must not be circular. Otherwise a circular dependency is only warned about.
+    The cmake_options are the keyword arguments of generate_cmake_substitutions.
+    The source_root is the folder the debian folder is placed in, the current directory by default, the
+    folders of the packages in debian/rules and debian/copyright are relative to it.
+    """
+    builder = RepoHeaderBuilder(all_subs.keys())
+    for sub in all_subs.values():
+        builder.add(sub)
+    waves = None
+    try:
+        waves = compute_build_waves(list(all_subs.values()))
+    except RuntimeError as exc:
+        if topological:
+            error(str(exc), exit=True)
+        warning(str(exc))
+    else:
+        debug("Build waves: {0}".format(' | '.join(', '.join(name for name, _ in wave) for wave in waves)))
+    repo_header = builder.build(sanitize_package_name(source_package), waves if topological else None,
+                                generate_cmake_substitutions(**(cmake_options or {})), source_root)
+
+    if repo_header['Package'] in all_subs:
+        error("The source package '{0}' has the name of one of the packages of the repository"
+              .format(repo_header['Package']), exit=True)
     all_subs[repo_header['Package']] = repo_header
     return all_subs
 
 
-def __process_template_folder(path, subs):
-    items = os.listdir(path)
-    processed_items = []
-    master = subs['tesseract-core']
-    for item in list(items):
-        if (item != 'control_package.em'):
-            full_path = os.path.abspath(os.path.join(path, item))
-            if os.path.basename(full_path) in ['.', '..', '.git', '.svn']:
-                continue
-            if os.path.isdir(full_path):
-                sub_items = __process_template_folder(full_path, subs)
-                processed_items.extend([os.path.join(full_path, s) for s in sub_items])
-            if not full_path.endswith(TEMPLATE_EXTENSION):
-                continue
-            with open(full_path, 'r') as f:
-                template = f.read()
-            # Remove extension
-            template_path = full_path[:-len(TEMPLATE_EXTENSION)]
-            if item == 'control_header.em':
-                template_path = full_path[:-len('_header.em')]
-
-            # Expand template
+def split_repo_header(all_subs):
+    """
+    Return the substitutions of the source package added by add_repo_header
+    and the list of the substitutions of the packages of the repository.
+    """
+    packages_subs = list(all_subs.values())
+    return packages_subs.pop(), packages_subs
+
+
+def write_file_atomically(path, content, mode):
+    """
+    Write content, text or bytes, to path through a temporary file in the
+    same directory which is then renamed over path, so a partially written
+    file is never visible. The permissions are set to mode.
+    """
+    write_chunks_atomically(path, [content], mode)
+
+
+def write_chunks_atomically(path, chunks, mode):
+    """Like write_file_atomically, but writes the text or bytes produced by the iterable chunks one at a time."""
+    tmp_path, _ = _write_temporary_chunks(path, chunks)
+    try:
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _write_temporary_chunks(path, chunks):
+    """
+    Write the chunks into a temporary file next to path, hashing them on the
+    way, and return the path of the temporary file and the SHA-1 of its content.
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.',
+                                    dir=os.path.dirname(path) or os.curdir)
+    sha = hashlib.sha1()
+    try:
+        with io.open(fd, 'wb') as f:
+            for chunk in chunks:
+                chunk = _to_bytes(chunk)
+                sha.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, sha.hexdigest()
+
+
+def iter_copyright_paragraphs(packages_subs, source_root):
+    """
+    Yield the Files and stand-alone License paragraphs of a machine-readable
+    (DEP-5) debian/copyright for the packages with the given substitutions.
+
+    Every package gets a Files paragraph for its directory, relative to
+    source_root, the folder the debian folder is placed in. Each distinct
+    license file, by content hash, becomes a single License paragraph which
+    is read line by line while it is written, so at most one line of a
+    license text is held in memory.
+    """
+    # License file hash -> (short name, path)
+    license_paragraphs = collections.OrderedDict()
+    used_names = {}
+    for subs in packages_subs:
+        names = []
+        for name, license_file, license_digest in subs['Licenses']:
+            short_name = '-'.join(name.split()) or 'unknown'
+            if license_digest is not None:
+                if license_digest not in license_paragraphs:
+                    # Differing texts under the same name need distinct short names
+                    count = used_names.get(short_name, 0) + 1
+                    used_names[short_name] = count
+                    if count > 1:
+                        short_name = '{0}-{1}'.format(short_name, count)
+                    license_paragraphs[license_digest] = (short_name, license_file)
+                short_name = license_paragraphs[license_digest][0]
+            if short_name not in names:
+                names.append(short_name)
+        files = get_source_folder(subs, source_root)
+        yield u'\nFiles: {0}\nCopyright: {1}\nLicense: {2}\n'.format(
+            '*' if files == os.curdir else files + '/*',
+            '\n '.join(subs.get('MaintainerList') or [subs['Maintainer']]),
+            ' and '.join(names) or 'unknown')
+    for short_name, license_file in license_paragraphs.values():
+        yield u'\nLicense: {0}\n'.format(short_name)
+        with io.open(license_file, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                line = line.rstrip()
+                yield u' {0}\n'.format(line) if line else u' .\n'
+
+
+def _to_bytes(chunk):
+    return chunk if isinstance(chunk, bytes) else chunk.encode('utf-8')
+
+
+class CompiledTemplate(object):
+    """
+    An empy template which is scanned into tokens once and can then be
+    expanded repeatedly with different substitutions.
+    """
+
+    def __init__(self, source, scan=True):
+        em = _import_empy()
+        self.source = source
+        self.tokens = None
+        if scan and hasattr(em, 'Scanner') and hasattr(em, 'Stream'):
+            scanner = em.Scanner(em.DEFAULT_PREFIX, source)
+            if source and source[-1] != '\n':
+                # Same dummy terminator em.Interpreter.safe adds for the final pass
+                scanner.feed(em.DEFAULT_PREFIX + '\n')
+            self.tokens = []
+            token = scanner.one()
+            while token is not None:
+                self.tokens.append(token)
+                token = scanner.one()
+
+
+class TemplateEngine(object):
+    """
+    Loads each template once, keyed by the hash of its content, and expands
+    it with a single, reused empy interpreter.
+
+    Falls back to em.expand for versions of empy which do not expose their
+    scanner, or when precompile is False.
+
+    The interpreters do not replace sys.stdout with empy's proxy, which
+    would send what other threads print, e.g. their log messages, into the
+    template which is being expanded.
+    """
+
+    def __init__(self, precompile=True):
+        self.precompile = precompile
+        self._templates = {}
+        self._interpreter = None
+        self._lock = threading.Lock()
+
+    def load(self, path):
+        with open(path, 'r') as f:
+            source = f.read()
+        return self.compile(source)
+
+    def compile(self, source):
+        digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        with self._lock:
+            template = self._templates.get(digest)
+            if template is None:
+                template = CompiledTemplate(source, scan=self.precompile)
+                self._templates[digest] = template
+        return template
+
+    def expand(self, template, subs):
+        em = _import_empy()
+        if template.tokens is None:
+            return em.expand(template.source, _options={em.OVERRIDE_OPT: False}, **subs)
+        with self._lock:
+            if self._interpreter is None:
+                self._interpreter = em.Interpreter(output=em.NullFile(), options={em.OVERRIDE_OPT: False})
+                atexit.register(self.shutdown)
+            output = em.StringIO()
+            stream = em.Stream(output)
+            self._interpreter.streams.push(stream)
+            try:
+                # All tokens of one expansion share the locals, e.g. for loop variables
+                locals = dict(subs)
+                for token in template.tokens:
+                    token.run(self._interpreter, locals)
+                stream.flush()
+                return output.getvalue()
+            finally:
+                self._interpreter.streams.pop()
+
+    def shutdown(self):
+        with self._lock:
+            if self._interpreter is not None:
+                self._interpreter.shutdown()
+                self._interpreter = None
+
+
+_template_engine = TemplateEngine()
+
+
+def get_template_engine():
+    return _template_engine
+
+
+def iter_debian_tree(templates, subs, debian_path='debian'):
+    """
+    Expand the templates of a debian folder with the substitutions returned
+    by merge_packages, without touching the file system.
+
+    The control file is the expanded control_header.em followed by the
+    stanza of each package, expanded from the control_package_<build type>.em
+    of its build type if there is one and control_package.em otherwise. The
+    install_package.em is expanded into the <package>.install of each package.
+    The packages in UnchangedPackages get neither a stanza nor an install file.
+
+    :param templates: dict mapping paths relative to the debian folder to
+        (content bytes, mode), as returned by read_template_tree
+    :param debian_path: path of the debian folder, only used in messages
+    :returns: generator of (path relative to the debian folder, iterable of
+        text or bytes chunks, mode) of the files of the debian folder, files
+        which are not templates are passed through as they are
+    """
+    master, packages_subs = split_repo_header(subs)
+    unchanged = set(master['UnchangedPackages'])
+    published_subs = [pkg for pkg in packages_subs if pkg['Package'] not in unchanged]
+
+    def expand(template_path, output_path, subs, label=None, log=True):
+        template = _template_engine.compile(templates[template_path][0].decode('utf-8'))
+        if log:
             info("Expanding '{0}' -> '{1}'".format(
-                os.path.relpath(full_path),
-                os.path.relpath(template_path)))
-            result = em.expand(template, **master)
-            # Don't write an empty file
-            if len(result) == 0 and \
-               os.path.basename(template_path) in ['copyright']:
-                processed_items.append(full_path)
-                continue
-            # Write the result
-            with io.open(template_path, 'w', encoding='utf-8') as f:
-                if sys.version_info.major == 2:
-                    result = result.decode('utf-8')
-                f.write(result)
-            # Copy the permissions
-            shutil.copymode(full_path, template_path)
-            processed_items.append(full_path)
-
-    # Now process the control_package.em for each package in the repository
-    item = 'control_package.em'
-    full_path = os.path.abspath(os.path.join(path, item))
-    if os.path.exists(full_path):
-        with open(full_path, 'r') as f:
-            template = f.read()
-        # Remove extension
-        template_path = full_path[:-len('_package.em')]
-
-        # Expand template
-        info("Expanding '{0}' -> '{1}'".format(
-            os.path.relpath(full_path),
-            os.path.relpath(template_path)))
-
-        for key, pkg in subs.items():
-            if pkg['Package'] != 'tesseract-core':
-                result = em.expand(template, **pkg)
-                # Write the result
-                with io.open(template_path, 'a', encoding='utf-8') as f:
-                    if sys.version_info.major == 2:
-                        result = result.decode('utf-8')
-                    f.write(result)
-
-        processed_items.append(full_path)
-
-    return processed_items
+                os.path.join(debian_path, template_path), os.path.join(debian_path, output_path)))
+        with timed('template expansion', label or os.path.join(debian_path, output_path)):
+            return _template_engine.expand(template, subs)
+
+    for rel_path in sorted(templates):
+        content, mode = templates[rel_path]
+        if not rel_path.endswith(TEMPLATE_EXTENSION):
+            yield rel_path, [content], mode
+        elif rel_path == 'copyright.em':
+            header = expand(rel_path, 'copyright', master)
+            if header and not header.endswith('\n'):
+                header += '\n'
+            # Streamed together with the license texts of all packages
+            yield 'copyright', itertools.chain(
+                [header], iter_copyright_paragraphs(packages_subs, master['SourceRoot'])), mode
+        elif rel_path != 'control_header.em' and not rel_path.startswith(PACKAGE_TEMPLATE_PREFIXES):
+            output_path = rel_path[:-len(TEMPLATE_EXTENSION)]
+            yield output_path, [expand(rel_path, output_path, master)], mode
+
+    if 'control_header.em' in templates or 'control_package.em' in templates:
+        # Assemble the whole control file before it is written, so a failing
+        # expansion never leaves a partial control file behind
+        chunks = []
+        mode = None
+        if 'control_header.em' in templates:
+            chunks.append(expand('control_header.em', 'control', master))
+            mode = templates['control_header.em'][1]
+        if 'control_package.em' in templates:
+            if mode is None:
+                mode = templates['control_package.em'][1]
+            for index, pkg in enumerate(published_subs):
+                template_path = 'control_package_{0}.em'.format(pkg.get('BuildType'))
+                if template_path not in templates:
+                    template_path = 'control_package.em'
+                chunks.append(expand(template_path, 'control', pkg, '{0} ({1})'.format(
+                    os.path.join(debian_path, 'control'), pkg['Name']), log=index == 0))
+        yield 'control', chunks, mode
+
+    if 'install_package.em' in templates:
+        for pkg in published_subs:
+            output_path = '{0}.install'.format(pkg['Package'])
+            yield output_path, [expand('install_package.em', output_path, pkg)], templates['install_package.em'][1]
+
+
+def render_debian_tree(all_subs, build_type, gbp=False):
+    """
+    Render the debian folder of a repository in memory, independent of the
+    working directory.
+
+    :param all_subs: substitutions of the packages and the repository, as returned by merge_packages
+    :param build_type: build type whose templates are used, see get_repo_build_type
+    :returns: OrderedDict mapping the paths of the files relative to the
+        debian folder to (content bytes, mode)
+    """
+    tree = collections.OrderedDict()
+    for rel_path, chunks, mode in iter_debian_tree(get_template_tree(build_type, gbp), all_subs):
+        tree[rel_path] = (b''.join(_to_bytes(chunk) for chunk in chunks), mode)
+    return tree
+
+
+def _write_debian_files(debian_path, files):
+    for rel_path, chunks, mode in files:
+        file_path = os.path.join(debian_path, rel_path)
+        if not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        write_chunks_atomically(file_path, chunks, mode)
+
+
+def write_debian_tree(path, tree):
+    """
+    Replace the debian folder in path with the files of tree, as returned by
+    render_debian_tree or get_template_tree.
+    """
+    debian_path = os.path.join(path, 'debian')
+    if os.path.exists(debian_path):
+        shutil.rmtree(debian_path)
+    _write_debian_files(debian_path, ((rel_path, [content], mode) for rel_path, (content, mode) in tree.items()))
+
+
+def generate_debian_folder(path, all_subs, build_type, gbp=False):
+    """
+    Replace the debian folder in path with the one rendered from all_subs,
+    like write_debian_tree(path, render_debian_tree(...)), but streaming each
+    file to disk as it is expanded.
+    """
+    debian_path = os.path.join(path, 'debian')
+    if os.path.exists(debian_path):
+        shutil.rmtree(debian_path)
+    _write_debian_files(debian_path, iter_debian_tree(get_template_tree(build_type, gbp), all_subs, debian_path))
 
 
 def process_template_files(path, subs):
+    """
+    Expand the templates in the debian folder in path in place.
+
+    :returns: list of the paths of the expanded templates
+    """
     info(fmt("@!@{bf}==>@| In place processing templates in 'debian' folder."))
     debian_dir = os.path.join(path, 'debian')
     if not os.path.exists(debian_dir):
         sys.exit("No debian directory found at '{0}', cannot process templates."
                  .format(debian_dir))
-    return __process_template_folder(debian_dir, subs)
+    templates = dict(
+        (rel_path, template) for rel_path, template in read_template_tree(debian_dir).items()
+        if rel_path.endswith(TEMPLATE_EXTENSION))
+    _write_debian_files(debian_dir, iter_debian_tree(templates, subs, debian_dir))
+    return [os.path.abspath(os.path.join(debian_dir, rel_path)) for rel_path in sorted(templates)]
+
+
+def get_package_input_files(package):
+    """Return the files of a package which the generated debian folder depends on."""
+    package_path = os.path.dirname(package.filename)
+    files = [package.filename]
+    changelog_path = os.path.join(package_path, CHANGELOG_FILENAME)
+    if os.path.exists(changelog_path):
+        files.append(changelog_path)
+    setup_cfg_path = os.path.join(package_path, 'setup.cfg')
+    if os.path.exists(setup_cfg_path):
+        files.append(setup_cfg_path)
+    for l in package.licenses:
+        if hasattr(l, 'file') and l.file is not None:
+            files.append(os.path.join(package_path, l.file))
+    return files
+
+
+def fingerprint_inputs(pkgs_dict, template_dir, options):
+    """
+    Return a hash over everything the generated debian folder depends on: the
+    package.xml, CHANGELOG.rst, setup.cfg and license files of every package,
+    the template files, the generator itself, the release tags the releasers
+    of the changelog entries come from and the given options.
+    """
+    files = [os.path.abspath(__file__)]
+    for pkg in pkgs_dict.values():
+        files.extend(get_package_input_files(pkg))
+    for root, dirs, names in os.walk(template_dir):
+        dirs.sort()
+        files.extend(os.path.join(root, name) for name in sorted(names))
+    if _rosdep_snapshot is not None:
+        options = dict(options, rosdep_snapshot=_rosdep_snapshot.digest())
+    else:
+        options = dict(options, rosdep_sources=get_rosdep_sources_fingerprint())
+    package_dirs = sorted(os.path.dirname(os.path.abspath(pkg.filename)) for pkg in pkgs_dict.values())
+    if package_dirs:
+        options = dict(options, release_tags=get_release_tags_fingerprint(package_dirs[0]))
+    sha = hashlib.sha1(json.dumps(options, sort_keys=True).encode('utf-8'))
+    for file_path in files:
+        sha.update(file_path.encode('utf-8') + b'\0')
+        if os.path.exists(file_path):
+            sha.update(_hash_file(file_path).encode('utf-8'))
+    return sha.hexdigest()
+
+
+MANIFEST_FILENAME = '.repo_debian_generator_manifest.json'
+
+
+def load_manifest(path):
+    """Load the manifest stored next to the debian folder in path, if any."""
+    manifest_path = os.path.join(path, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as exc:
+        warning("Ignoring unreadable manifest '{0}': {1}".format(manifest_path, exc))
+        return None
+
+
+def save_manifest(path, fingerprint, files):
+    with open(os.path.join(path, MANIFEST_FILENAME), 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'files': files}, f, indent=2, sort_keys=True)
+
+
+def _hash_file(file_path):
+    sha = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def is_debian_folder_up_to_date(path, manifest, fingerprint):
+    """
+    Check whether the debian folder in path was generated from inputs with the
+    given fingerprint and has not been modified since.
+    """
+    if manifest is None or manifest.get('fingerprint') != fingerprint:
+        return False
+    debian_path = os.path.join(path, 'debian')
+    for rel_path, digest in manifest.get('files', {}).items():
+        file_path = os.path.join(debian_path, rel_path)
+        if not os.path.isfile(file_path) or _hash_file(file_path) != digest:
+            return False
+    return True
+
+
+def sync_debian_tree(tree, debian_path, previous_files=None):
+    """
+    Make debian_path match the files of tree, as returned by
+    iter_debian_tree, only replacing files whose content or permissions
+    differ so unchanged files keep their mtime. Files listed in
+    previous_files which are no longer generated are removed.
+
+    The chunks of each file are streamed into a temporary file and hashed on
+    the way, so a large file, like the copyright with all license texts, is
+    never held in memory as a whole.
+
+    :returns: dict mapping each generated file, relative to debian_path, to its hash
+    """
+    files = {}
+    for rel_path, chunks, mode in tree:
+        dst = os.path.join(debian_path, rel_path)
+        if not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+        tmp_path, files[rel_path] = _write_temporary_chunks(dst, chunks)
+        try:
+            if os.path.isfile(dst) and _hash_file(dst) == files[rel_path]:
+                os.remove(tmp_path)
+                if stat.S_IMODE(os.stat(dst).st_mode) != mode:
+                    os.chmod(dst, mode)
+                continue
+            info("Updating '{0}'".format(os.path.relpath(dst)))
+            os.chmod(tmp_path, mode)
+            os.rename(tmp_path, dst)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    for rel_path in previous_files or []:
+        dst = os.path.join(debian_path, rel_path)
+        if rel_path not in files and os.path.isfile(dst):
+            info("Removing stale '{0}'".format(os.path.relpath(dst)))
+            os.remove(dst)
+    return files
+
+
+def update_debian_folder(path, build_type, subs, fingerprint, manifest=None, gbp=False):
+    """
+    Regenerate the debian folder in path incrementally.
+
+    The files of the debian folder are expanded with iter_debian_tree and
+    synced into path with sync_debian_tree, and the manifest next to the
+    debian folder is updated with the given input fingerprint.
+    """
+    previous_files = (manifest or {}).get('files', {})
+    debian_path = os.path.join(path, 'debian')
+    files = sync_debian_tree(iter_debian_tree(get_template_tree(build_type, gbp), subs, debian_path),
+                             debian_path, previous_files)
+    save_manifest(path, fingerprint, files)
+    return files
+
+
+class RepositoryWatcher(object):
+    """
+    Waits for changes to a set of files, using inotify when the optional
+    inotify_simple module is available and polling their stat otherwise.
+    """
+
+    # Editors often write a file in several steps, wait this long for the rest of them
+    SETTLE_TIME = 0.05
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        try:
+            import inotify_simple
+        except ImportError:
+            debug(traceback.format_exc())
+            inotify_simple = None
+        self._inotify_simple = inotify_simple
+        self._inotify = None
+        self._watches = {}
+        self._files = set()
+        self._stats = {}
+
+    @property
+    def backend(self):
+        return 'inotify' if self._inotify_simple is not None else 'polling'
+
+    def watch(self, files):
+        """Watch files, which replace the previously watched files."""
+        self._files = set(os.path.abspath(f) for f in files)
+        # Keep the known state of files, so a change while regenerating is not lost
+        self._stats = dict((f, self._stats[f] if f in self._stats else self._stat(f)) for f in self._files)
+        if self._inotify_simple is None:
+            return
+        if self._inotify is None:
+            self._inotify = self._inotify_simple.INotify()
+        flags = self._inotify_simple.flags
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.CREATE | flags.DELETE
+        for directory in set(os.path.dirname(f) for f in self._files):
+            if directory not in self._watches.values() and os.path.isdir(directory):
+                self._watches[self._inotify.add_watch(directory, mask)] = directory
+
+    @staticmethod
+    def _stat(file_path):
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size, st.st_ino
+
+    def wait(self):
+        """Block until at least one watched file changed and return the changed files."""
+        while True:
+            if self._inotify is not None:
+                events = self._inotify.read()
+                time.sleep(self.SETTLE_TIME)
+                events.extend(self._inotify.read(timeout=0))
+                touched = set(os.path.join(self._watches.get(e.wd, ''), e.name) for e in events)
+                candidates = self._files & touched
+            else:
+                time.sleep(self.interval)
+                candidates = self._files
+            changed = set()
+            for file_path in candidates:
+                stat = self._stat(file_path)
+                if stat != self._stats.get(file_path):
+                    self._stats[file_path] = stat
+                    changed.add(file_path)
+            if changed:
+                return changed
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+
+def watch_repository(pkgs_dict, all_subs, get_subs_fn, os_name, os_version, ros_distro, install_prefix,
+                     path, build_type, options, native=False, interval=0.5):
+    """
+    Keep the debian folder in path up to date until interrupted.
+
+    The packages, their substitutions, the caches and the compiled templates
+    stay in memory. When an input file of a package changes only that package
+    is parsed and its substitutions generated again; the repository header is
+    aggregated from the kept substitutions and the debian folder is updated
+    with update_debian_folder, so only files whose content changed are written.
+    """
+    from catkin_pkg.package import parse_package
+
+    # All templates, the stanzas of packages may come from those of other build types
+    template_dir = TEMPLATES_DIR
+    package_subs = collections.OrderedDict(
+        (key, all_subs[pkg.name]) for key, pkg in pkgs_dict.items())
+    watcher = RepositoryWatcher(interval)
+
+    def watched_files():
+        files = {}
+        for key, pkg in pkgs_dict.items():
+            for file_path in get_package_input_files(pkg):
+                files[os.path.abspath(file_path)] = key
+            # Catch a CHANGELOG.rst or setup.cfg which does not exist yet
+            package_path = os.path.abspath(os.path.dirname(pkg.filename))
+            for name in (CHANGELOG_FILENAME, 'setup.cfg'):
+                files.setdefault(os.path.join(package_path, name), key)
+        for root, dirs, names in os.walk(template_dir):
+            for name in names:
+                files[os.path.abspath(os.path.join(root, name))] = None
+        return files
+
+    files = watched_files()
+    watcher.watch(files)
+    info(fmt("@!@{gf}==> @|") + "Watching {0} files of {1} packages for changes ({2}), press Ctrl-C to stop"
+         .format(len(files), len(pkgs_dict), watcher.backend))
+    try:
+        while True:
+            changed = watcher.wait()
+            start = time.time()
+            keys = set(files[f] for f in changed if files.get(f) is not None)
+            try:
+                for key in keys:
+                    pkg = parse_package(os.path.dirname(pkgs_dict[key].filename))
+                    pkgs_dict[key] = pkg
+                    package_subs[key] = get_subs_fn(pkg, os_name, os_version, ros_distro, install_prefix, native)
+                subs = add_repo_header(collections.OrderedDict(
+                    (s['Name'], s) for s in package_subs.values()), options.get('topological_build', False),
+                    options.get('cmake_options'), options.get('source_package', DEFAULT_SOURCE_PACKAGE),
+                    options.get('source_root', path))
+                fingerprint = fingerprint_inputs(pkgs_dict, template_dir, options)
+                update_debian_folder(path, build_type, subs, fingerprint, load_manifest(path))
+            except (Exception, SystemExit) as exc:
+                # Most likely a file which is being edited, keep watching for the fix
+                debug(traceback.format_exc())
+                error("Regenerating failed: {0}: {1}".format(type(exc).__name__, exc))
+            else:
+                info(fmt("@!@{gf}==> @|") + "Regenerated for changes to {0} in {1:.0f} ms".format(
+                    ', '.join(sorted(pkgs_dict[k].name for k in keys)) or 'the templates',
+                    (time.time() - start) * 1000))
+            files = watched_files()
+            watcher.watch(files)
+    except KeyboardInterrupt:
+        info("Stopped watching")
+    finally:
+        watcher.close()
+
+
+# Debian increments of the packages, kept next to the debian folder by the change-impact analysis
+IMPACT_STATE_FILENAME = '.repo_debian_generator_increments.json'
+
+# package.xml dependencies through which a change of a package affects the packages depending on it
+IMPACT_DEPENDENCY_TYPES = (
+    'build_depends', 'buildtool_depends', 'build_export_depends', 'buildtool_export_depends',
+    'exec_depends', 'run_depends', 'test_depends',
+)
+
+
+def resolve_revision_range(revision_range, directory=None):
+    """
+    Resolve a git revision range 'BASE..HEAD', or 'BASE' for 'BASE..HEAD',
+    where each revision is a branch, tag or commit, into the pair of their
+    commit hashes.
+
+    Only git rev-parse is used, the checkout and the branches are never
+    touched, unlike with bloom.git.get_commit_hash which tracks remote branches.
+    """
+    base, _, head = revision_range.partition('..')
+    hashes = []
+    for reference in (base, head or 'HEAD'):
+        try:
+            hashes.append(check_output(['git', 'rev-parse', '--verify', '--quiet', reference + '^{commit}'],
+                                       cwd=directory).strip())
+        except CalledProcessError:
+            error("Unknown git revision '{0}' in '{1}'".format(reference, revision_range), exit=True)
+        debug("Revision '{0}' is {1}".format(reference, hashes[-1]))
+    return tuple(hashes)
+
+
+def get_changed_files(base, head, directory=None):
+    """Return the paths, relative to the git root, of the files which changed between the commits base and head."""
+    output = check_output(['git', 'diff', '--name-only', '-z', base, head], cwd=directory)
+    return [path for path in output.split('\0') if path]
+
+
+def map_files_to_packages(files, root, pkgs_dict, exclude=None):
+    """
+    Map changed files, relative to the git root, to the packages in pkgs_dict
+    whose folder contains them, the innermost one for nested folders.
+
+    :param exclude: fnmatch patterns of files which do not affect any package, e.g. 'docs/*'
+    :returns: the set of the names of the changed packages and the list of the
+        changed files which are in no package, which affect all packages
+    """
+    root = os.path.realpath(root)
+    package_dirs = sorted(
+        ((os.path.relpath(os.path.realpath(os.path.dirname(pkg.filename)), root), pkg.name)
+         for pkg in pkgs_dict.values()),
+        key=lambda item: len(item[0]), reverse=True)
+    changed = set()
+    unowned = []
+    for path in files:
+        if any(fnmatch.fnmatch(path, pattern) for pattern in exclude or []):
+            continue
+        for package_dir, name in package_dirs:
+            if package_dir == os.curdir or path.startswith(package_dir + '/'):
+                changed.add(name)
+                break
+        else:
+            unowned.append(path)
+    return changed, unowned
+
+
+def find_affected_packages(changed, pkgs_dict):
+    """
+    Return the set of the names of the changed packages and of all packages
+    of pkgs_dict which depend on one of them, directly or through other
+    packages of the repository.
+    """
+    names = set(pkg.name for pkg in pkgs_dict.values())
+    dependents = collections.defaultdict(set)
+    for pkg in pkgs_dict.values():
+        for dep_type in IMPACT_DEPENDENCY_TYPES:
+            for dep in getattr(pkg, dep_type, None) or []:
+                if dep.name in names and dep.name != pkg.name:
+                    dependents[dep.name].add(pkg.name)
+    affected = set(changed)
+    queue = collections.deque(changed)
+    while queue:
+        for name in dependents[queue.popleft()]:
+            if name not in affected:
+                affected.add(name)
+                queue.append(name)
+    return affected
+
+
+def analyze_change_impact(pkgs_dict, revision_range, path, state=None, exclude=None):
+    """
+    Find the packages of pkgs_dict which are affected by the changes in the
+    git revision range, see resolve_revision_range, and bump their Debian
+    increments, see bump_debian_increments.
+
+    Changed files which are in no package, e.g. a top level CMakeLists.txt,
+    affect all packages. The debian folder in path and the files generated
+    next to it are ignored. If the debian folder was already generated for
+    the head of the range, state is returned as it is, so running again does
+    not bump the increments twice.
+
+    :param exclude: fnmatch patterns of files, relative to the git root,
+        which do not affect any package
+    """
+    root = get_root(os.path.abspath(path or os.curdir))
+    if root is None:
+        error("'{0}' is not in a git repository".format(os.path.abspath(path or os.curdir)), exit=True)
+    base, head = resolve_revision_range(revision_range, root)
+    if state is not None and state.get('revision') == head:
+        info("The Debian increments are up to date with {0}".format(head))
+        return state
+    output_dir = os.path.relpath(os.path.realpath(path or os.curdir), os.path.realpath(root))
+    generated = ['debian/*', '.repo_debian_generator_*']
+    if output_dir != os.curdir:
+        generated = [output_dir + '/' + pattern for pattern in generated]
+    changed, unowned = map_files_to_packages(
+        get_changed_files(base, head, root), root, pkgs_dict, list(exclude or []) + generated)
+    if unowned:
+        info("Files outside of the packages changed, e.g. '{0}', all packages are affected".format(unowned[0]))
+        changed = set(pkg.name for pkg in pkgs_dict.values())
+    return bump_debian_increments(pkgs_dict, find_affected_packages(changed, pkgs_dict), state, head)
+
+
+def load_impact_state(path):
+    """Load the Debian increments stored next to the debian folder in path, if any."""
+    state_path = os.path.join(path, IMPACT_STATE_FILENAME)
+    if not os.path.exists(state_path):
+        return None
+    try:
+        with open(state_path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as exc:
+        warning("Ignoring unreadable Debian increments '{0}': {1}".format(state_path, exc))
+        return None
+
+
+def save_impact_state(path, state):
+    write_file_atomically(os.path.join(path, IMPACT_STATE_FILENAME),
+                          json.dumps(state, indent=2, sort_keys=True) + '\n', 0o644)
+
+
+def bump_debian_increments(pkgs_dict, affected, state=None, revision=None):
+    """
+    Return the new state of the Debian increments, with the increment of the
+    affected packages, and of the source package if any package is affected,
+    bumped. A package whose version changed, or which is not in the previous
+    state, starts over at 0 and is affected too, as it was never published
+    with that version. The other packages keep their increment.
+
+    :param state: the previous state, as returned by load_impact_state, or
+        None if nothing was published yet
+    :param revision: the commit the debian folder is generated for
+    :returns: dict with the 'revision', the 'affected' packages, which are
+        the only ones to publish, and the 'source' and 'packages'
+        (name -> {'version', 'inc'}) increments
+    """
+    state = state or {}
+    previous = state.get('packages', {})
+
+    def bump(entry, version, changed):
+        if entry is None or entry['version'] != version:
+            return {'version': version, 'inc': 0}
+        return {'version': version, 'inc': entry['inc'] + 1 if changed else entry['inc']}
+
+    affected = set(affected)
+    affected.update(
+        pkg.name for pkg in pkgs_dict.values()
+        if previous.get(pkg.name, {}).get('version') != pkg.version)
+    packages = dict(
+        (pkg.name, bump(previous.get(pkg.name), pkg.version, pkg.name in affected))
+        for pkg in pkgs_dict.values())
+    source_version = str(max((pkg.version for pkg in pkgs_dict.values()), key=parse_version))
+    return {
+        'revision': revision,
+        'affected': sorted(affected),
+        'source': bump(state.get('source'), source_version, bool(affected)),
+        'packages': packages,
+    }
+
+
+def apply_debian_increments(all_subs, state):
+    """
+    Return all_subs, as returned by merge_packages, with the Debian increments
+    of state, see bump_debian_increments.
+
+    The source package, and so the packages which keep its version, get the
+    increment of the source package. The rules generate the control data of
+    the other affected packages with their own version. The packages which
+    are not affected were already published with their version, so they are
+    still built, as the others may need them, but their binary packages are
+    left out of the control file and never published again.
+    """
+    master, packages_subs = split_repo_header(all_subs)
+    source_inc = '-{0}'.format(state['source']['inc'])
+    source_version = master['changelogs'][0][0] + source_inc + master['Distribution']
+    result = collections.OrderedDict()
+    binary_versions = []
+    unchanged = []
+    affected = set(state['affected'])
+    for subs in packages_subs:
+        entry = state['packages'][subs['Name']]
+        debian_inc = '-{0}'.format(entry['inc'])
+        version = subs['Version'] + debian_inc + subs['Distribution']
+        if subs['Name'] not in affected:
+            unchanged.append(subs['Package'])
+        elif version != source_version:
+            binary_versions.append((subs['Package'], version))
+        if isinstance(subs, Substitutions):
+            result[subs['Name']] = type(subs)(subs, DebianInc=debian_inc)
+        else:
+            result[subs['Name']] = dict(subs, DebianInc=debian_inc)
+    fields = {'DebianInc': source_inc, 'BinaryVersions': binary_versions, 'UnchangedPackages': unchanged}
+    if isinstance(master, Substitutions):
+        result[master['Package']] = type(master)(master, **fields)
+    else:
+        result[master['Package']] = dict(master, **fields)
+    return result
+
+
+def parse_target(value):
+    """Parse an 'os_name:os_version:ros_distro' target, e.g. 'ubuntu:focal:noetic'."""
+    target = tuple(value.split(':'))
+    if len(target) != 3 or not all(target):
+        raise ValueError("Invalid target '{0}', expected 'os_name:os_version:ros_distro'".format(value))
+    return target
+
+
+def generate_targets(pkgs_dict, targets, install_prefix, output_dir, build_type, native=False, jobs=1,
+                     topological=False, cmake_options=None, source_package=DEFAULT_SOURCE_PACKAGE, source_root=None):
+    """
+    Generate one debian folder per (os_name, os_version, ros_distro) target,
+    each in its own directory below output_dir, to be placed in source_root,
+    the current directory by default.
+
+    The distribution independent substitutions (descriptions, changelogs,
+    copyright, ...) are generated once for all targets. Only the dependency
+    resolution and the template expansion are done per target. The
+    dependencies of all targets are resolved concurrently, the templates are
+    then expanded for one target after the other.
+
+    :returns: dict mapping each target to the directory containing its debian folder
+    """
+    def get_common_subs(pkg, os_name, os_version, ros_distro, install_prefix, native):
+        return generate_common_substitutions(pkg, install_prefix, native=native)
+    common_subs = dict(
+        (subs['Name'], subs) for subs in generate_package_substitutions(
+            pkgs_dict, get_common_subs, None, None, None, install_prefix, native, jobs))
+
+    def get_target_subs(pkg, os_name, os_version, ros_distro, install_prefix, native):
+        return generate_distro_substitutions(pkg, common_subs[pkg.name], os_name, os_version, ros_distro)
+
+    def get_target_all_subs(target):
+        os_name, os_version, ros_distro = target
+        return merge_packages(pkgs_dict, get_target_subs, os_name, os_version, ros_distro, install_prefix,
+                              native, jobs, topological, cmake_options, source_package, source_root)
+
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        targets_subs = list(executor.map(get_target_all_subs, targets))
+
+    # The templates are expanded one target after the other, with no other
+    # thread logging while empy evaluates them
+    target_paths = collections.OrderedDict()
+    for target, all_subs in zip(targets, targets_subs):
+        target_path = os.path.join(output_dir, '-'.join(target))
+        if not os.path.isdir(target_path):
+            os.makedirs(target_path)
+        generate_debian_folder(target_path, all_subs, build_type)
+        target_paths[target] = target_path
+    return target_paths
+
+
+BATCH_RESULT_FILENAME = '.repo_debian_generator_result.json'
+
+
+def load_batch_manifest(path):
+    """
+    Load the repositories of a batch manifest, a YAML (or JSON) file like::
+
+        defaults:
+          target: ubuntu:focal:noetic
+          install_prefix: /opt
+        repositories:
+          - path: tesseract
+            source_package: tesseract_core
+          - path: trajopt
+            source_package: trajopt
+            target: ubuntu:jammy:humble
+
+    Each repository needs a path, relative to the manifest, a source_package
+    and a target, and can set install_prefix, native and exclude, which
+    default to the values in defaults.
+
+    :returns: list of dicts with the path, source_package, target tuple,
+        install_prefix, native and exclude of each repository
+    """
+    import yaml
+
+    with open(path, 'r') as f:
+        manifest = yaml.safe_load(f) or {}
+    defaults = dict({'install_prefix': '/opt', 'native': False, 'exclude': []}, **(manifest.get('defaults') or {}))
+    repositories = []
+    for index, entry in enumerate(manifest.get('repositories') or []):
+        repository = dict(defaults, **entry)
+        missing = [key for key in ('path', 'source_package', 'target') if not repository.get(key)]
+        if missing:
+            error("Repository {0} of the batch manifest '{1}' has no {2}"
+                  .format(index + 1, path, ', '.join(missing)), exit=True)
+        repository['path'] = os.path.abspath(os.path.join(os.path.dirname(path), repository['path']))
+        repository['target'] = parse_target(repository['target'])
+        repositories.append(repository)
+    if not repositories:
+        error("The batch manifest '{0}' lists no repositories".format(path), exit=True)
+    return repositories
+
+
+def generate_repository(repository, pkgs_dict, options=None):
+    """
+    Generate the debian folder of one repository of a batch manifest, as
+    loaded by load_batch_manifest, and write its result next to it.
+
+    Failures are reported in the result rather than raised, so one broken
+    repository does not stop the others.
+
+    :returns: dict with the path, source_package, target, packages, status,
+        error and seconds of the repository
+    """
+    options = options or {}
+    start = time.time()
+    path = repository['path']
+    os_name, os_version, ros_distro = repository['target']
+    result = collections.OrderedDict([
+        ('path', path),
+        ('source_package', repository['source_package']),
+        ('target', ':'.join(repository['target'])),
+        ('packages', sorted(pkg.name for pkg in pkgs_dict.values())),
+        ('status', 'ok'),
+        ('error', None),
+    ])
+    try:
+        build_type = get_repo_build_type(pkgs_dict)
+        load_changelogs(pkgs_dict, path)
+
+        def get_subs_fn(pkg, os_name, os_version, ros_distro, install_prefix, native):
+            return generate_substitutions_from_package(pkg, os_name, os_version, ros_distro, install_prefix,
+                                                       native=native)
+        all_subs = merge_packages(pkgs_dict, get_subs_fn, os_name, os_version, ros_distro,
+                                  repository['install_prefix'], repository['native'], 1,
+                                  options.get('topological_build', False), options.get('cmake_options'),
+                                  repository['source_package'], path)
+        generate_debian_folder(path, all_subs, build_type)
+    except (Exception, SystemExit) as exc:
+        debug(traceback.format_exc())
+        result['status'] = 'failed'
+        if isinstance(exc, SystemExit):
+            # bloom's error(exit=True) exits with the colored message
+            result['error'] = strip_ansi(exc.code) if isinstance(exc.code, str) else 'Exited with {0}'.format(exc.code)
+        else:
+            result['error'] = '{0}: {1}'.format(type(exc).__name__, exc)
+    result['seconds'] = time.time() - start
+    with open(os.path.join(path, BATCH_RESULT_FILENAME), 'w') as f:
+        json.dump(result, f, indent=2)
+    return result
+
+
+def generate_batch(repositories, jobs=None, options=None, rosdep_concurrency=8):
+    """
+    Generate the debian folders of all repositories of a batch manifest in
+    one run.
+
+    The work which benefits from being shared, discovering the packages,
+    parsing their changelogs, resolving their rosdep keys and compiling the
+    templates, is done once in this process for all repositories. The
+    repositories are then generated by a pool of jobs forked processes,
+    which inherit the loaded rosdep views and caches.
+
+    :returns: list of the results of generate_repository, in the order of repositories
+    """
+    pkgs_dicts = []
+    for repository in repositories:
+        with timed('package discovery', repository['path']):
+            pkgs_dicts.append(find_packages(repository['path'], repository['exclude']))
+    changelog_paths = []
+    for pkgs_dict in pkgs_dicts:
+        for pkg in pkgs_dict.values():
+            changelog_path = os.path.join(os.path.abspath(os.path.dirname(pkg.filename)), CHANGELOG_FILENAME)
+            if os.path.exists(changelog_path):
+                changelog_paths.append(changelog_path)
+    cache = _changelog_cache or enable_changelog_cache()
+    with timed('changelog stage'):
+        cache.parse_all(changelog_paths, jobs)
+    if rosdep_concurrency > 0 and _rosdep_snapshot is None:
+        # The keys of each repository are only needed for its own target
+        pkgs_by_target = collections.defaultdict(collections.OrderedDict)
+        for repository, pkgs_dict in zip(repositories, pkgs_dicts):
+            pkgs_by_target[repository['target']].update((pkg.filename, pkg) for pkg in pkgs_dict.values())
+        with timed('rosdep prefetch'):
+            for target in sorted(pkgs_by_target):
+                prefetch_rosdep_keys(pkgs_by_target[target], [target], rosdep_concurrency)
+    for root, dirs, files in os.walk(TEMPLATES_DIR):
+        for name in files:
+            if name.endswith(TEMPLATE_EXTENSION):
+                _template_engine.load(os.path.join(root, name))
+
+    results = [None] * len(repositories)
+    with timed('repository generation'):
+        if jobs is None or jobs <= 1 or len(repositories) <= 1:
+            for index, repository in enumerate(repositories):
+                results[index] = generate_repository(repository, pkgs_dicts[index], options)
+        else:
+            import multiprocessing
+            # Forked workers share what was loaded above instead of each loading it again
+            context = multiprocessing.get_context('fork')
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as executor:
+                futures = dict(
+                    (executor.submit(generate_repository, repository, pkgs_dicts[index], options), index)
+                    for index, repository in enumerate(repositories))
+                for future in as_completed(futures):
+                    results[futures[future]] = future.result()
+    return results
 
 
 def match_branches_with_prefix(prefix, get_branches, prune=False):
@@ -0,0 +1,356 @@
+"""
+Benchmarks for the repository debian generator.
+
+Usage:
+    python repo_debian_generator_bench.py templates [--packages 500]
+    python repo_debian_generator_bench.py pipeline [--sizes 10,100,1000] [--json FILE]
+    python repo_debian_generator_bench.py importtime [--budget 100] [--baseline bloom.logging] [--json FILE]
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from bloom.logging import quiet
+
+import repo_debian_generator
+
+from repo_debian_generator import DEFAULT_SOURCE_PACKAGE
+from repo_debian_generator import TemplateEngine
+from repo_debian_generator import TEMPLATE_EXTENSION
+from repo_debian_generator import TEMPLATES_DIR
+from repo_debian_generator import enable_changelog_cache
+from repo_debian_generator import enable_package_index
+from repo_debian_generator import find_packages
+from repo_debian_generator import generate_cmake_substitutions
+from repo_debian_generator import generate_substitutions_from_package
+from repo_debian_generator import load_changelogs
+from repo_debian_generator import merge_packages
+from repo_debian_generator import render_debian_tree
+
+# rosdep keys of the synthetic repositories and what the in-memory resolver maps them to
+SYNTHETIC_ROSDEP_KEYS = {
+    'boost': ['libboost-all-dev'],
+    'cmake': ['cmake'],
+    'eigen': ['libeigen3-dev'],
+    'gtest': ['libgtest-dev'],
+    'python3-numpy': ['python3-numpy'],
+    'python3-setuptools': ['python3-setuptools'],
+    'yaml-cpp': ['libyaml-cpp-dev'],
+}
+
+SYNTHETIC_BUILD_TYPES = ['cmake', 'catkin', 'ament_cmake', 'ament_python']
+
+
+def synthetic_substitutions(count):
+    """Return substitutions resembling those of a repository with count packages."""
+    all_subs = {}
+    for i in range(count):
+        name = 'synthetic_pkg_{0}'.format(i)
+        all_subs[name] = {
+            'Name': name,
+            'Package': name.replace('_', '-'),
+            'Version': '1.2.{0}'.format(i),
+            'Description': 'Synthetic package {0}.\n It only exists to be benchmarked.'.format(i),
+            'Homepage': 'https://example.com/{0}'.format(name),
+            'DebianInc': '-0',
+            'format': 'quilt',
+            'InstallationPrefix': '/opt',
+            'BuildType': 'cmake',
+            'BuildTypes': ['cmake'],
+            'PythonPackages': [],
+            'Packages': [(name, name.replace('_', '-'), name, 'cmake', False)],
+            'BuildWaves': [],
+            'BinaryVersions': [],
+            'UnchangedPackages': [],
+            'SourceRoot': os.sep,
+            'Maintainer': 'Jane Doe <jane@example.com>',
+            'Maintainers': 'Jane Doe <jane@example.com>',
+            'Depends': ['libboost-all-dev', 'libeigen3-dev (>= 3.3)'] +
+                       ['synthetic-pkg-{0}'.format(d) for d in range(max(0, i - 3), i)],
+            'BuildDepends': ['cmake', 'libboost-all-dev', 'libeigen3-dev (>= 3.3)', 'libgtest-dev'],
+            'Conflicts': [],
+            'Replaces': ['old-{0}'.format(i)] if i % 10 == 0 else [],
+            'PackagePath': os.path.join(os.sep, 'src', name),
+            'Licenses': [('BSD', None, None)],
+            'Distribution': 'focal',
+            'debhelper_version': 9,
+            'changelogs': [
+                ('1.2.{0}'.format(i), 'Fri, 01 May 2020 00:00:00 -0000', '  * Change {0}'.format(v),
+                 'Jane Doe', 'jane@example.com')
+                for v in range(5)],
+            'release_tag': 'release/{0}'.format(name),
+        }
+        all_subs[name].update(generate_cmake_substitutions())
+    return all_subs
+
+
+def render_repository(engine, template_dir, all_subs):
+    """Render every template in template_dir like iter_debian_tree does, without writing files."""
+    master = next(iter(all_subs.values()))
+    size = 0
+    for root, dirs, files in os.walk(template_dir):
+        for name in files:
+            if not name.endswith(TEMPLATE_EXTENSION):
+                continue
+            template = engine.load(os.path.join(root, name))
+            if name in ('control_package.em', 'install_package.em'):
+                for subs in all_subs.values():
+                    size += len(engine.expand(template, subs))
+            else:
+                size += len(engine.expand(template, master))
+    return size
+
+
+def bench_templates(args):
+    all_subs = synthetic_substitutions(args.packages)
+    print("Rendering '{0}' for {1} synthetic packages, best of {2}:"
+          .format(args.template_dir, args.packages, args.repeat))
+    timings = {}
+    for precompile in (False, True):
+        label = 'precompiled' if precompile else 'em.expand'
+        best = None
+        for _ in range(args.repeat):
+            # A fresh engine per repetition, so loading and scanning is included
+            engine = TemplateEngine(precompile=precompile)
+            start = time.time()
+            render_repository(engine, args.template_dir, all_subs)
+            elapsed = time.time() - start
+            engine.shutdown()
+            best = elapsed if best is None else min(best, elapsed)
+        timings[label] = best
+        print("  {0:<12} {1:8.3f} s".format(label, best))
+    print("  speedup      {0:8.2f}x".format(timings['em.expand'] / timings['precompiled']))
+
+
+def synthesize_repository(path, count, versions=5):
+    """
+    Create a repository of count packages in path, each with a package.xml,
+    CHANGELOG.rst and LICENSE, cycling through the supported build types and
+    depending on a few of the preceding packages.
+    """
+    for i in range(count):
+        name = 'synthetic_pkg_{0}'.format(i)
+        build_type = SYNTHETIC_BUILD_TYPES[i % len(SYNTHETIC_BUILD_TYPES)]
+        package_path = os.path.join(path, name)
+        os.makedirs(package_path)
+        if build_type == 'ament_python':
+            build_tools = ['python3-setuptools']
+            depends = ['python3-numpy']
+            with open(os.path.join(package_path, 'setup.cfg'), 'w') as f:
+                f.write('[develop]\nscript-dir=$base/lib/{0}\n'.format(name))
+        else:
+            build_tools = ['catkin' if build_type == 'catkin' else 'cmake']
+            depends = ['boost', 'eigen', 'yaml-cpp'][:1 + i % 3]
+        depends += ['synthetic_pkg_{0}'.format(d) for d in range(max(0, i - 3), i)]
+        version = '1.{0}.0'.format(versions - 1)
+        with open(os.path.join(package_path, 'package.xml'), 'w') as f:
+            f.write('<?xml version="1.0"?>\n<package format="3">\n')
+            f.write('  <name>{0}</name>\n  <version>{1}</version>\n'.format(name, version))
+            f.write('  <description>Synthetic package {0}. It only exists to be benchmarked.</description>\n'
+                    .format(i))
+            f.write('  <maintainer email="jane@example.com">Jane Doe</maintainer>\n')
+            f.write('  <license file="LICENSE">BSD</license>\n')
+            f.write('  <url type="website">https://example.com/{0}</url>\n'.format(name))
+            for key in build_tools:
+                f.write('  <buildtool_depend>{0}</buildtool_depend>\n'.format(key))
+            for key in depends:
+                f.write('  <depend>{0}</depend>\n'.format(key))
+            f.write('  <test_depend>gtest</test_depend>\n')
+            f.write('  <export><build_type>{0}</build_type></export>\n</package>\n'.format(build_type))
+        with open(os.path.join(package_path, 'CHANGELOG.rst'), 'w') as f:
+            title = 'Changelog for package {0}'.format(name)
+            f.write('{0}\n{1}\n{0}\n\n'.format('^' * len(title), title))
+            for v in reversed(range(versions)):
+                header = '1.{0}.0 (2020-01-{1:02d})'.format(v, v + 1)
+                f.write('{0}\n{1}\n* Change number {2} of {3}\n* Another change\n\n'
+                        .format(header, '-' * len(header), v, name))
+        with open(os.path.join(package_path, 'LICENSE'), 'w') as f:
+            f.write('Copyright (c) Jane Doe\n\n' + 'Redistribution and use is permitted.\n' * 20)
+
+
+def in_memory_resolve_rosdep_key(key, os_name, os_version, ros_distro=None, ignored=None, retry=True):
+    """Stand-in for bloom's resolve_rosdep_key which never loads the rosdep database."""
+    if key in SYNTHETIC_ROSDEP_KEYS:
+        return list(SYNTHETIC_ROSDEP_KEYS[key]), 'apt', 'apt'
+    return None, None, None
+
+
+def offline_evaluate_package_conditions(package, ros_distro):
+    """Stand-in for bloom's evaluate_package_conditions which does not fetch the rosdistro index."""
+    package.evaluate_conditions({'ROS_VERSION': '1', 'ROS_DISTRO': ros_distro, 'ROS_PYTHON_VERSION': '3'})
+
+
+def measure(stages, name, fn, *args):
+    """Run fn, recording its wall time and peak traced memory in stages[name]."""
+    tracemalloc.start()
+    start = time.time()
+    try:
+        return fn(*args)
+    finally:
+        elapsed = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        stages[name] = {'seconds': elapsed, 'peak_bytes': peak}
+
+
+def bench_repository(count, os_name='ubuntu', os_version='focal', ros_distro='noetic', install_prefix='/opt'):
+    """Run each stage of the generator on a synthetic repository of count packages."""
+    work_path = tempfile.mkdtemp(prefix='repo_debian_generator_bench_')
+    stages = collections.OrderedDict()
+    try:
+        repo_path = os.path.join(work_path, 'repo')
+        synthesize_repository(repo_path, count)
+        # A fresh, in-memory only index, then a second pass answered from it
+        enable_package_index()
+        pkgs_dict = measure(stages, 'find_packages', find_packages, repo_path)
+        measure(stages, 'find_packages (indexed)', find_packages, repo_path)
+        # A fresh, in-memory only cache so no changelog is parsed by an earlier run
+        enable_changelog_cache()
+        measure(stages, 'load_changelogs', load_changelogs, pkgs_dict, repo_path)
+
+        def generate_all():
+            return dict(
+                (pkg.name, generate_substitutions_from_package(pkg, os_name, os_version, ros_distro, install_prefix))
+                for pkg in pkgs_dict.values())
+        subs = measure(stages, 'generate_substitutions_from_package', generate_all)
+
+        def get_subs_fn(pkg, *args):
+            return subs[pkg.name]
+        all_subs = measure(stages, 'merge_packages', merge_packages, pkgs_dict, get_subs_fn,
+                           os_name, os_version, ros_distro, install_prefix, False, 1, False, None,
+                           DEFAULT_SOURCE_PACKAGE, repo_path)
+        measure(stages, 'render_debian_tree', render_debian_tree, all_subs, 'cmake')
+    finally:
+        shutil.rmtree(work_path)
+    return stages
+
+
+def bench_pipeline(args):
+    # Answer every rosdep query from memory, without loading the rosdep database
+    repo_debian_generator.resolve_rosdep_key = in_memory_resolve_rosdep_key
+    repo_debian_generator.evaluate_package_conditions = offline_evaluate_package_conditions
+    results = collections.OrderedDict()
+    for count in [int(c) for c in args.sizes.split(',')]:
+        quiet(True)
+        try:
+            results[count] = bench_repository(count)
+        finally:
+            quiet(False)
+        print("Synthetic repository with {0} packages:".format(count))
+        print("  {0:<40} {1:>10} {2:>12}".format('stage', 'time [s]', 'peak [MiB]'))
+        for stage, result in results[count].items():
+            print("  {0:<40} {1:10.3f} {2:12.2f}".format(
+                stage, result['seconds'], result['peak_bytes'] / (1024.0 * 1024.0)))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def measure_import_time(module, baseline=None):
+    """
+    Import module in a fresh interpreter with -X importtime and return its
+    cumulative import time and that of every module it imported, in microseconds.
+
+    The baseline module, if any, is imported first, so the time of module
+    only covers what it imports on top of the baseline. The modules imported
+    by the baseline or at the interpreter startup are not returned, only
+    those nested below module in the -X importtime output.
+    """
+    code = 'import ' + module
+    if baseline:
+        code = 'import {0}; {1}'.format(baseline, code)
+    cmd = [sys.executable, '-X', 'importtime', '-c', code]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), universal_newlines=True)
+    stderr = proc.communicate()[1]
+    if proc.returncode != 0:
+        sys.exit("Importing '{0}' failed:\n{1}".format(module, stderr))
+    lines = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # A module is listed after the modules it imports, which are indented deeper
+        lines.append((name.strip(), len(name) - len(name.lstrip()), int(self_us), int(cumulative_us)))
+    index = max(i for i, line in enumerate(lines) if line[0] == module)
+    depth = lines[index][1]
+    start = index
+    while start > 0 and lines[start - 1][1] > depth:
+        start -= 1
+    modules = collections.OrderedDict(
+        (name, (self_us, cumulative_us)) for name, _, self_us, cumulative_us in lines[start:index + 1])
+    return modules[module][1], modules
+
+
+def bench_importtime(args):
+    best = None
+    for _ in range(args.repeat):
+        total, modules = measure_import_time(args.module, args.baseline)
+        if best is None or total < best[0]:
+            best = (total, modules)
+    total, modules = best
+    print("Importing '{0}'{1} takes {2:.1f} ms, best of {3} (budget: {4:.0f} ms)"
+          .format(args.module, " on top of '{0}'".format(args.baseline) if args.baseline else '',
+                  total / 1000.0, args.repeat, args.budget))
+    print("  {0:<50} {1:>10} {2:>14}".format('module', 'self [ms]', 'cumulative [ms]'))
+    heaviest = sorted((m for m in modules.items() if m[0] != args.module), key=lambda m: -m[1][1])
+    for name, (self_us, cumulative_us) in heaviest[:args.top]:
+        print("  {0:<50} {1:10.1f} {2:14.1f}".format(name, self_us / 1000.0, cumulative_us / 1000.0))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'module': args.module, 'baseline': args.baseline, 'total_us': total, 'budget_ms': args.budget,
+                       'modules': modules}, f, indent=2)
+    if total / 1000.0 > args.budget:
+        print("Import time exceeds the budget of {0:.0f} ms".format(args.budget))
+        return 1
+
+
+def main(sysargs=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for the repository debian generator")
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    templates = subparsers.add_parser('templates', help="compare em.expand with the precompiled template engine")
+    templates.add_argument('--packages', type=int, default=500, help="number of synthetic packages (default: 500)")
+    templates.add_argument('--repeat', type=int, default=3, help="number of repetitions (default: 3)")
+    templates.add_argument('--template-dir', default=os.path.join(TEMPLATES_DIR, 'cmake'),
+                           help="template directory to render (default: the cmake templates)")
+    templates.set_defaults(func=bench_templates)
+
+    pipeline = subparsers.add_parser('pipeline', help="time each stage of the generator on synthetic repositories")
+    pipeline.add_argument('--sizes', default='10,100,1000',
+                          help="comma separated numbers of packages of the synthetic repositories (default: 10,100,1000)")
+    pipeline.add_argument('--json', metavar='FILE', help="also write the results to FILE as JSON")
+    pipeline.set_defaults(func=bench_pipeline)
+
+    importtime = subparsers.add_parser('importtime', help="check the import time of the command line tool")
+    importtime.add_argument('--module', default='repo_debian_generator_cmd',
+                            help="module to import (default: repo_debian_generator_cmd)")
+    importtime.add_argument('--baseline', default='bloom.logging',
+                            help="module imported first, whose import time is not counted, '' for none "
+                                 "(default: bloom.logging, which every run of the tool imports and which "
+                                 "alone takes about 330 ms through pkg_resources)")
+    importtime.add_argument('--budget', type=float, default=100,
+                            help="fail if importing the module on top of the baseline takes longer than this "
+                                 "many milliseconds (default: 100)")
+    importtime.add_argument('--repeat', type=int, default=3, help="number of repetitions (default: 3)")
+    importtime.add_argument('--top', type=int, default=15, help="number of heaviest imports to list (default: 15)")
+    importtime.add_argument('--json', metavar='FILE', help="also write the results to FILE as JSON")
+    importtime.set_defaults(func=bench_importtime)
+
+    args = parser.parse_args(sysargs)
+    sys.exit(args.func(args) or 0)
+
+
+if __name__ == '__main__':
+    main()
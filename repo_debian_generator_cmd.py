@@ -35,6 +35,7 @@ from __future__ import print_function
 
 import argparse
 
+import json
 import os
 import sys
 import traceback
@@ -43,25 +44,54 @@ from bloom.logging import debug
 from bloom.logging import error
 from bloom.logging import fmt
 from bloom.logging import info
+from bloom.logging import warning
 
-from debian_generator import generate_substitutions_from_package
-from debian_generator import merge_packages
-from debian_generator import place_template_files
-from debian_generator import process_template_files
+from repo_debian_generator import COMPILER_CACHES
+from repo_debian_generator import DEFAULT_SOURCE_PACKAGE
+from repo_debian_generator import IMPACT_STATE_FILENAME
+from repo_debian_generator import TEMPLATES_DIR
+from repo_debian_generator import analyze_change_impact
+from repo_debian_generator import apply_debian_increments
+from repo_debian_generator import enable_changelog_cache
+from repo_debian_generator import enable_package_index
+from repo_debian_generator import enable_rosdep_cache
+from repo_debian_generator import enable_rosdep_snapshot
+from repo_debian_generator import enable_timings
+from repo_debian_generator import find_packages
+from repo_debian_generator import fingerprint_inputs
+from repo_debian_generator import generate_batch
+from repo_debian_generator import generate_debian_folder
+from repo_debian_generator import generate_substitutions_from_package
+from repo_debian_generator import generate_targets
+from repo_debian_generator import get_cache_dir
+from repo_debian_generator import get_package_index
+from repo_debian_generator import get_repo_build_type
+from repo_debian_generator import get_rosdep_cache
+from repo_debian_generator import is_debian_folder_up_to_date
+from repo_debian_generator import load_batch_manifest
+from repo_debian_generator import load_changelogs
+from repo_debian_generator import load_impact_state
+from repo_debian_generator import load_manifest
+from repo_debian_generator import merge_packages
+from repo_debian_generator import parse_target
+from repo_debian_generator import place_template_files
+from repo_debian_generator import prefetch_rosdep_keys
+from repo_debian_generator import process_template_files
+from repo_debian_generator import save_impact_state
+from repo_debian_generator import timed
+from repo_debian_generator import update_debian_folder
+from repo_debian_generator import watch_repository
+from repo_debian_generator import write_rosdep_snapshot
 
-from bloom.util import get_distro_list_prompt
 
-try:
-    from rosdep2 import create_default_installer_context
-except ImportError:
-    debug(traceback.format_exc())
-    error("rosdep was not detected, please install it.", exit=True)
-
-try:
-    from catkin_pkg.packages import find_packages
-except ImportError:
-    debug(traceback.format_exc())
-    error("catkin_pkg was not detected, please install it.", exit=True)
+# rosdep is imported when used, so e.g. --help starts quickly
+def create_default_installer_context():
+    try:
+        from rosdep2 import create_default_installer_context
+    except ImportError:
+        debug(traceback.format_exc())
+        error("rosdep was not detected, please install it.", exit=True)
+    return create_default_installer_context()
 
 
 def prepare_arguments(parser):
@@ -74,12 +104,96 @@ def prepare_arguments(parser):
         help="places debian/* template files only")
     add('--process-template-files', action='store_true',
         help="processes templates in debian/* only")
+    add('--snapshot', metavar='FILE', default=None,
+        help="resolves the rosdep keys of all packages for the targets and writes them "
+             "to the rosdep snapshot FILE only, see --rosdep-snapshot")
+    add('--batch', metavar='MANIFEST', default=None,
+        help="generates the debian folders of all repositories listed in the YAML MANIFEST, each with its "
+             "path, source_package, target and install_prefix, using --jobs processes")
     add = parser.add_argument
+    add('--batch-summary', metavar='FILE', default=None,
+        help="write the results of all repositories of --batch to FILE as JSON")
+    add('--source-package', default=DEFAULT_SOURCE_PACKAGE,
+        help="name of the source package of the repository (default: %(default)s)")
     add('--os-name', help='OS name, e.g. ubuntu, debian')
     add('--os-version', help='OS version or codename, e.g. precise, wheezy')
-    add('--ros-distro', help="ROS distro, e.g. %s (used for rosdep)" % get_distro_list_prompt())
+    # Listing the distros would fetch the rosdistro index just to print the help
+    add('--ros-distro', help="ROS distro, e.g. noetic, humble (used for rosdep)")
+    add('--target', action='append', type=parse_target, metavar='OS_NAME:OS_VERSION:ROS_DISTRO',
+        help="generate a debian folder for this target, e.g. ubuntu:focal:noetic, into "
+             "OUTPUT_DIR/<os_name>-<os_version>-<ros_distro>/debian; can be given multiple times "
+             "and overrides --os-name, --os-version and --ros-distro")
+    add('--output-dir', default=os.curdir,
+        help="directory to write the per target debian folders to, which are to be placed in the package path "
+             "(default: current directory)")
     add('--install-prefix', default=None, help="overrides the default installation prefix (/usr)")
     add('--native', action='store_true', help="generate native package")
+    add('-j', '--jobs', type=int, default=1,
+        help="number of packages to generate substitutions for in parallel (default: 1)")
+    add('--incremental', action='store_true',
+        help="only rewrite files in debian/ whose content changed, skipping generation entirely "
+             "if none of the inputs changed since the last run")
+    add('--watch', action='store_true',
+        help="after generating, keep running and update the debian folder whenever a package.xml, "
+             "CHANGELOG.rst, setup.cfg, license file or template changes (implies --incremental)")
+    add('--watch-interval', type=float, default=0.5,
+        help="seconds between checks for changes when inotify_simple is not installed (default: 0.5)")
+    add('--changed-since', metavar='REVISION_RANGE', default=None,
+        help="only bump the Debian increment of the packages changed in the git REVISION_RANGE, "
+             "'BASE..HEAD' or 'BASE' for 'BASE..HEAD', and of the packages of the repository depending on "
+             "them, which keep their versions in %s next to the debian folder; "
+             "nothing is generated if no package changed" % IMPACT_STATE_FILENAME)
+    add('--impact-exclude', action='append', default=[], metavar='GLOB',
+        help="changes of files whose path relative to the git root matches GLOB, e.g. 'docs/*' or '*.md', "
+             "do not affect any package for --changed-since; can be given multiple times")
+    add('--topological-build', action='store_true',
+        help="make debian/rules configure, build and install the packages one by one in the order of their "
+             "build dependencies, building independent packages concurrently as allowed by the parallel "
+             "option of DEB_BUILD_OPTIONS, instead of configuring the repository root once")
+    add('--compiler-cache', choices=COMPILER_CACHES, default=None,
+        help="make debian/rules use this compiler cache as the compiler launcher of the CMake packages, "
+             "so repeated builds reuse its cache, e.g. through CCACHE_DIR or SCCACHE_DIR")
+    add('--unity-build', action='store_true',
+        help="make debian/rules build the CMake packages as unity builds (CMAKE_UNITY_BUILD)")
+    add('--build-type', dest='cmake_build_type', metavar='CMAKE_BUILD_TYPE', default=None,
+        help="CMAKE_BUILD_TYPE of the CMake packages in debian/rules, e.g. Release or RelWithDebInfo "
+             "(default: the one of debhelper)")
+    add('--ninja', action='store_true',
+        help="make debian/rules build the CMake packages with Ninja instead of Makefiles")
+    add('--exclude', action='append', default=[], metavar='GLOB',
+        help="do not look for packages in folders whose name or path relative to the package path "
+             "matches GLOB, e.g. 'build' or 'vendor/*'; can be given multiple times")
+    add('--package-index', metavar='FILE', default=None,
+        help="file used to persist the parsed package.xml files between runs "
+             "(default: %s)" % os.path.join(get_cache_dir(), 'package_index.pickle'))
+    add('--no-package-index', action='store_true',
+        help="parse every package.xml, without using or updating the package index")
+    add('--rosdep-cache', metavar='FILE', default=None,
+        help="file used to persist resolved rosdep keys between runs "
+             "(default: %s)" % os.path.join(get_cache_dir(), 'rosdep_cache.json'))
+    add('--no-rosdep-cache', action='store_true',
+        help="resolve every rosdep key with rosdep, without using or updating the persisted cache")
+    add('--rosdep-snapshot', metavar='FILE', default=None,
+        help="resolve rosdep keys and package conditions from a snapshot written by --snapshot, without loading "
+             "rosdep or rosdistro; the target defaults to the one in the snapshot")
+    add('--rosdep-concurrency', type=int, default=8,
+        help="number of rosdep keys to resolve concurrently before generating the substitutions, "
+             "0 resolves the keys of each package when it is generated (default: 8)")
+    add('--rosdep-timeout', type=float, default=None,
+        help="seconds after which resolving a rosdep key is given up on and the key is used as is "
+             "(default: no timeout)")
+    add('--no-changelog-cache', action='store_true',
+        help="parse every CHANGELOG.rst, without using or updating the cache of parsed changelogs")
+    add('--changelog-depth', type=int, metavar='N', default=None,
+        help="only parse the newest N versions of each CHANGELOG.rst and keep the newest N versions "
+             "in debian/changelog (default: all of them)")
+    add('--changelog-since', metavar='VERSION', default=None,
+        help="only parse the versions of each CHANGELOG.rst newer than VERSION, "
+             "a version or release tag like 'release/1.2.3'")
+    add('--timings', '--profile', action='store_true',
+        help="print how long each stage, package and template took")
+    add('--timings-trace', metavar='FILE', default=None,
+        help="write the timings to FILE in the Chrome trace event format (implies --timings)")
     return parser
 
 
@@ -98,31 +212,6 @@ def sanitize_package_name(name):
     return name.replace('_', '-')
 
 
-def convertToUnicode(obj):
-    if sys.version_info.major == 2:
-        if isinstance(obj, str):
-            return unicode(obj.decode('utf8'))
-        elif isinstance(obj, unicode):
-            return obj
-    else:
-        if isinstance(obj, bytes):
-            return str(obj.decode('utf8'))
-        elif isinstance(obj, str):
-            return obj
-    if isinstance(obj, list):
-        for i, val in enumerate(obj):
-            obj[i] = convertToUnicode(val)
-        return obj
-    elif isinstance(obj, type(None)):
-        return None
-    elif isinstance(obj, tuple):
-        obj_tmp = list(obj)
-        for i, val in enumerate(obj_tmp):
-            obj_tmp[i] = convertToUnicode(obj_tmp[i])
-        return tuple(obj_tmp)
-    elif isinstance(obj, int):
-        return obj
-
 def build_debian_pkg(args=None, get_subs_fn=None):
     get_subs_fn = get_subs_fn or get_subs
     _place_template_files = True
@@ -133,52 +222,247 @@ def build_debian_pkg(args=None, get_subs_fn=None):
         _place_template_files = args.place_template_files
         _process_template_files = args.process_template_files
 
-    pkgs_dict = find_packages(package_path)
+    package_index_path = None
+    if not args.no_package_index:
+        package_index_path = args.package_index or os.path.join(get_cache_dir(), 'package_index.pickle')
+    package_index = enable_package_index(package_index_path)
+    if args.batch:
+        return build_debian_batch(args)
+    with timed('package discovery'):
+        pkgs_dict = find_packages(package_path, args.exclude)
+    package_index.save()
+    debug("package index: {0} hits, {1} misses".format(package_index.hits, package_index.misses))
     if len(pkgs_dict) == 0:
         sys.exit("No packages found in path: '{0}'".format(package_path))
     # if len(pkgs_dict) > 1:
     #     sys.exit("Multiple packages found, "
     #              "this tool only supports one package at a time.")
 
-    os_data = create_default_installer_context().get_os_name_and_version()
-    os_name, os_version = os_data
-    ros_distro = os.environ.get('ROS_DISTRO', 'indigo')
+    path = ''
+    # The folders of the packages in debian/rules and debian/copyright are relative to the source tree the
+    # debian folder is placed in, which is the package path if the packages are not below the current directory
+    source_root = os.path.abspath(path or os.curdir)
+    if os.path.relpath(os.path.abspath(package_path), source_root).startswith(os.pardir):
+        warning("The packages are not below the current directory, the debian folder is generated for, and "
+                "has to be placed in, '{0}'".format(os.path.abspath(package_path)))
+        source_root = os.path.abspath(package_path)
+    # The templates of the repository, the stanzas of the packages use those of their own build type
+    build_type = get_repo_build_type(pkgs_dict)
+
+    if args.watch and (args.target or _place_template_files or _process_template_files):
+        error("--watch can not be combined with --target, --place-template-files or --process-template-files",
+              exit=True)
 
-    # Allow args overrides
-    os_name = args.os_name or os_name
-    os_version = args.os_version or os_version
-    ros_distro = args.ros_distro or ros_distro
+    if _place_template_files and not args.target:
+        # Placing the templates does not need any substitutions
+        with timed('template placement'):
+            place_template_files(path, build_type)
+        return
+
+    rosdep_snapshot = None
+    if args.rosdep_snapshot:
+        rosdep_snapshot = enable_rosdep_snapshot(args.rosdep_snapshot)
+
+    if args.target:
+        targets = args.target
+    elif rosdep_snapshot is not None:
+        targets = [
+            target for target in rosdep_snapshot.get_targets()
+            if all(arg is None or arg == value
+                   for arg, value in zip((args.os_name, args.os_version, args.ros_distro), target))]
+        if len(targets) != 1:
+            error("Expected exactly one target of the rosdep snapshot '{0}' to match, found {1}, "
+                  "please use --target or --os-name, --os-version and --ros-distro"
+                  .format(args.rosdep_snapshot, len(targets)), exit=True)
+        os_name, os_version, ros_distro = targets[0]
+    else:
+        with timed('os detection'):
+            os_data = create_default_installer_context().get_os_name_and_version()
+        os_name, os_version = os_data
+        ros_distro = os.environ.get('ROS_DISTRO', 'indigo')
+
+        # Allow args overrides
+        os_name = args.os_name or os_name
+        os_version = args.os_version or os_version
+        ros_distro = args.ros_distro or ros_distro
+        targets = [(os_name, os_version, ros_distro)]
     install_prefix = args.install_prefix or "/opt"
+    cmake_options = {
+        'compiler_cache': args.compiler_cache,
+        'unity_build': args.unity_build,
+        'build_type': args.cmake_build_type,
+        'ninja': args.ninja,
+    }
+
+    if args.snapshot:
+        if not args.no_rosdep_cache:
+            enable_rosdep_cache(args.rosdep_cache or os.path.join(get_cache_dir(), 'rosdep_cache.json'))
+        with timed('rosdep snapshot'):
+            write_rosdep_snapshot(args.snapshot, pkgs_dict, targets, args.rosdep_concurrency)
+        if not args.no_rosdep_cache:
+            get_rosdep_cache().save()
+        info("Wrote rosdep snapshot for {0} to '{1}'"
+             .format(', '.join(':'.join(target) for target in targets), args.snapshot))
+        return
+
+    impact_state = None
+    if args.changed_since:
+        if args.native or args.target or args.watch:
+            error("--changed-since can not be combined with --native, --target or --watch", exit=True)
+        with timed('change impact analysis'):
+            impact_state = analyze_change_impact(pkgs_dict, args.changed_since, path, load_impact_state(path),
+                                                 args.impact_exclude)
+        if not impact_state['affected'] and os.path.isdir(os.path.join(path, 'debian')):
+            save_impact_state(path, impact_state)
+            info(fmt("@!@{gf}==> @|") + "No package changed in '{0}', nothing to do.".format(args.changed_since))
+            return
+        info("Affected packages: {0}".format(', '.join(impact_state['affected']) or 'none'))
+
+    incremental = (args.incremental or args.watch) and not args.target and not _process_template_files
+    if incremental:
+        options = {
+            'os_name': os_name,
+            'os_version': os_version,
+            'ros_distro': ros_distro,
+            'install_prefix': install_prefix,
+            'native': args.native,
+            'build_type': build_type,
+            'topological_build': args.topological_build,
+            'cmake_options': cmake_options,
+            'source_package': args.source_package,
+            'source_root': source_root,
+            'changelog_depth': args.changelog_depth,
+            'changelog_since': args.changelog_since,
+            'debian_increments': impact_state,
+        }
+        with timed('input fingerprint'):
+            fingerprint = fingerprint_inputs(pkgs_dict, TEMPLATES_DIR, options)
+        manifest = load_manifest(path)
+        if is_debian_folder_up_to_date(path, manifest, fingerprint) and not args.watch:
+            info(fmt("@!@{gf}==> @|") + "The debian folder is up to date, nothing to do.")
+            return
 
     # Summarize
     info(fmt("@!@{gf}==> @|") +
-         fmt("Generating debs for @{cf}%s:%s@| for package(s) %s" %
-             (os_name, os_version, [p.name for p in pkgs_dict.values()])))
+         fmt("Generating debs for @{cf}%s@| for package(s) %s" %
+             (', '.join('%s:%s' % target[:2] for target in targets), [p.name for p in pkgs_dict.values()])))
 
-    # Test Creating single
-    all_subs = merge_packages(pkgs_dict, get_subs_fn, os_name, os_version, ros_distro, install_prefix, args.native)
-    path = ''
-    build_type = 'cmake'
+    rosdep_cache = None
+    if not args.no_rosdep_cache and rosdep_snapshot is None:
+        rosdep_cache = enable_rosdep_cache(
+            args.rosdep_cache or os.path.join(get_cache_dir(), 'rosdep_cache.json'))
+
+    changelog_cache_path = None
+    if not args.no_changelog_cache:
+        changelog_cache_path = os.path.join(get_cache_dir(), 'changelog_cache.json')
+    enable_changelog_cache(changelog_cache_path, args.changelog_depth, args.changelog_since)
+    with timed('changelog stage'):
+        changelog_cache = load_changelogs(pkgs_dict, package_path, args.jobs)
+
+    if args.rosdep_concurrency > 0 and rosdep_snapshot is None:
+        with timed('rosdep prefetch'):
+            prefetch_rosdep_keys(pkgs_dict, targets, args.rosdep_concurrency, args.rosdep_timeout)
+
+    if args.target:
+        # The distribution independent substitutions are shared by all targets
+        with timed('target generation'):
+            target_paths = generate_targets(pkgs_dict, targets, install_prefix, args.output_dir, build_type,
+                                            args.native, args.jobs, args.topological_build, cmake_options,
+                                            args.source_package, package_path)
+    else:
+        # Test Creating single
+        with timed('substitution generation'):
+            all_subs = merge_packages(pkgs_dict, get_subs_fn, os_name, os_version, ros_distro, install_prefix,
+                                      args.native, args.jobs, args.topological_build, cmake_options,
+                                      args.source_package, source_root)
+        if impact_state is not None:
+            all_subs = apply_debian_increments(all_subs, impact_state)
+    changelog_cache.save()
+    if rosdep_cache is not None:
+        rosdep_cache.save()
+        info("rosdep resolution cache: {0} hits, {1} misses".format(rosdep_cache.hits, rosdep_cache.misses))
+    if args.target:
+        for target, target_path in target_paths.items():
+            info("Generated '{0}' for {1}".format(os.path.join(target_path, 'debian'), ':'.join(target)))
+        return
+
+    template_files = None
     try:
-        if _place_template_files:
-            # Place template files
-            place_template_files(path, build_type)
-        if _process_template_files:
+        if incremental:
+            with timed('template processing'):
+                update_debian_folder(path, build_type, all_subs, fingerprint, manifest)
+        elif _process_template_files:
             # Just process existing template files
-            template_files = process_template_files(path, all_subs)
-        if not _place_template_files and not _process_template_files:
-            # If neither, do both
-            place_template_files(path, build_type)
-            template_files = process_template_files(path, all_subs)
+            with timed('template processing'):
+                template_files = process_template_files(path, all_subs)
+        else:
+            # If neither, do both, without placing the templates on disk
+            with timed('template processing'):
+                generate_debian_folder(path, all_subs, build_type)
         if template_files is not None:
             for template_file in template_files:
                 os.remove(os.path.normpath(template_file))
+        if impact_state is not None:
+            save_impact_state(path, impact_state)
     except Exception as exc:
         debug(traceback.format_exc())
         error(type(exc).__name__ + ": " + str(exc), exit=True)
     except (KeyboardInterrupt, EOFError):
         sys.exit(1)
 
+    if args.watch:
+        watch_repository(pkgs_dict, all_subs, get_subs_fn, os_name, os_version, ros_distro, install_prefix,
+                         path, build_type, options, args.native, args.watch_interval)
+        changelog_cache.save()
+        if rosdep_cache is not None:
+            rosdep_cache.save()
+
+def build_debian_batch(args):
+    repositories = load_batch_manifest(args.batch)
+    if args.rosdep_snapshot:
+        enable_rosdep_snapshot(args.rosdep_snapshot)
+    rosdep_cache = None
+    if not args.no_rosdep_cache and not args.rosdep_snapshot:
+        rosdep_cache = enable_rosdep_cache(
+            args.rosdep_cache or os.path.join(get_cache_dir(), 'rosdep_cache.json'))
+    changelog_cache_path = None
+    if not args.no_changelog_cache:
+        changelog_cache_path = os.path.join(get_cache_dir(), 'changelog_cache.json')
+    changelog_cache = enable_changelog_cache(changelog_cache_path, args.changelog_depth, args.changelog_since)
+    options = {
+        'topological_build': args.topological_build,
+        'cmake_options': {
+            'compiler_cache': args.compiler_cache,
+            'unity_build': args.unity_build,
+            'build_type': args.cmake_build_type,
+            'ninja': args.ninja,
+        },
+    }
+
+    info(fmt("@!@{gf}==> @|") +
+         fmt("Generating debs for @{cf}%d@| repositories using %d processes" % (len(repositories), args.jobs)))
+    results = generate_batch(repositories, args.jobs, options, args.rosdep_concurrency)
+    get_package_index().save()
+    changelog_cache.save()
+    if rosdep_cache is not None:
+        rosdep_cache.save()
+
+    failed = [result for result in results if result['status'] != 'ok']
+    for result in results:
+        line = "{0} ({1}, {2} packages) {3} in {4:.1f} s".format(
+            result['path'], result['target'], len(result['packages']), result['status'], result['seconds'])
+        if result['status'] == 'ok':
+            info(fmt("@{gf}") + line)
+        else:
+            error(line + ": " + result['error'])
+    info("Generated {0} of {1} repositories".format(len(results) - len(failed), len(results)))
+    if args.batch_summary:
+        with open(args.batch_summary, 'w') as f:
+            json.dump(results, f, indent=2)
+        info("Wrote batch summary to '{0}'".format(args.batch_summary))
+    return 1 if failed else 0
+
+
 def main(sysargs=None):
     parser = argparse.ArgumentParser(
         description="Calls a generator on a local package, e.g. bloom-generate debian"
@@ -187,7 +471,18 @@ def main(sysargs=None):
 
     args = parser.parse_args(sysargs)
 
-    sys.exit(build_debian_pkg(args) or 0)
+    timings = None
+    if args.timings or args.timings_trace:
+        timings = enable_timings()
+    try:
+        result = build_debian_pkg(args)
+    finally:
+        if timings is not None:
+            timings.print_summary()
+            if args.timings_trace:
+                timings.write_chrome_trace(args.timings_trace)
+                info("Wrote timings trace to '{0}'".format(args.timings_trace))
+    sys.exit(result or 0)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
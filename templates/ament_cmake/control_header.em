@@ -0,0 +1,8 @@
+Source: @(Package)
+Section: misc
+Priority: optional
+Maintainer: @(Maintainer)
+Build-Depends: debhelper (>= @(debhelper_version).0.0), @(', '.join(BuildDepends))
+Homepage: @(Homepage)
+Standards-Version: 3.9.2
+
@@ -1 +1,4 @@
-@(Copyright)
\ No newline at end of file
+Format: https://www.debian.org/doc/packaging-manuals/copyright-format/1.0/
+Upstream-Name: @(Package)
+@[if Homepage]Source: @(Homepage)
+@[end if]
\ No newline at end of file
@@ -18,9 +18,94 @@ export PKG_CONFIG_PATH=@(InstallationPrefix)/lib/pkgconfig
 # 	https://github.com/ros-infrastructure/bloom/issues/327
 export DEB_CXXFLAGS_MAINT_APPEND=-DNDEBUG
 
+# Every package is installed into its own folder in debian/tmp, which its
+# debian/<package>.install moves into the package
+STAGING_DIR = $(CURDIR)/debian/tmp
+@[if CMakeArgs]@
+
+# Passed to CMake when configuring the packages, a compiler cache keeps its
+# cache between builds, e.g. in CCACHE_DIR or SCCACHE_DIR of the environment
+CMAKE_ARGS = @(' '.join(CMakeArgs))
+@[end if]@
+@[if PythonPackages]@
+
+# The Python packages are built with pybuild, each from its own folder, after
+# the CMake packages which are all configured in a single pass from the root
+PYBUILD_INSTALL_ARGS_BASE = --prefix "@(InstallationPrefix)" \
+	--install-lib "\$$base/lib/{interpreter}/site-packages"
+@[end if]@
+
 %:
-	dh $@@ -v --buildsystem=cmake
+	dh $@@ -v --buildsystem=@(CMakeBuildSystem)@[if PythonPackages] --with python3@[end if]
+
+@[if BuildWaves]@
+# The packages are configured, built and installed one by one, each after
+# the packages of the repository it depends on, which it finds in their
+# folders in debian/tmp. Independent packages are built concurrently, the
+# parallel=N option of DEB_BUILD_OPTIONS limits the jobs of all of them together.
+@[if CMakeBuildSystem == 'cmake+ninja']@
+# Ninja only joins these jobs from version 1.13 on, older versions run as many
+# jobs as there are CPUs for each package.
+@[end if]@
+NUMJOBS = $(patsubst parallel=%,%,$(filter parallel=%,$(DEB_BUILD_OPTIONS)))
+BUILD_DIR = $(CURDIR)/.obj-repo
+STAGING_PREFIX_PATH = @
+@[for name, package, directory, build_type, install_scripts in Packages]$(STAGING_DIR)/@(package)@(InstallationPrefix);@[end for]@(InstallationPrefix)
 
+override_dh_auto_configure:
+	# Done by the repo-build-<package> targets below
+
+override_dh_auto_build:
+	$(MAKE) -f debian/rules -j$(or $(NUMJOBS),1) @(' '.join('repo-build-' + p[0] for wave in BuildWaves for p in wave))
+
+override_dh_auto_test:
+	# In case we're installing to a non-standard location, look for a setup.sh
+	# in the install tree that was dropped by catkin, and source it.  It will
+	# set things like CMAKE_PREFIX_PATH, PKG_CONFIG_PATH, and PYTHONPATH.
+	echo -- Running tests. Even if one of them fails the build is not canceled.
+	if [ -f "@(InstallationPrefix)/setup.sh" ]; then . "@(InstallationPrefix)/setup.sh"; fi@
+@[for wave in BuildWaves]@[for name, package, directory, build_type, depends, install_scripts in wave]; \
+@[if build_type == 'ament_python']@
+	dh_auto_test --buildsystem=pybuild --sourcedirectory=@(directory) || true@
+@[else]@
+	dh_auto_test --buildsystem=@(CMakeBuildSystem) --sourcedirectory=@(directory) --builddirectory=$(BUILD_DIR)/@(name) || true@
+@[end if]@
+@[end for]@[end for]
+
+override_dh_auto_install:
+	# Done by the repo-build-<package> targets below
+@[for index, wave in enumerate(BuildWaves)]@
+@[for name, package, directory, build_type, depends, install_scripts in wave]@
+
+# Wave @(index + 1)
+repo-build-@(name):@(''.join(' repo-build-' + d for d in depends))
+	if [ -f "@(InstallationPrefix)/setup.sh" ]; then . "@(InstallationPrefix)/setup.sh"; fi && \
+@[if build_type == 'ament_python']@
+	dh_auto_configure --buildsystem=pybuild --sourcedirectory=@(directory) && \
+	dh_auto_build --buildsystem=pybuild --sourcedirectory=@(directory) && \
+	dh_auto_install --buildsystem=pybuild --sourcedirectory=@(directory) --destdir=$(STAGING_DIR)/@(package) -- \
+		--install-args='$(PYBUILD_INSTALL_ARGS_BASE)@[if install_scripts] --install-scripts "\$$base/bin"@[end if]'
+@[else]@
+	dh_auto_configure --buildsystem=@(CMakeBuildSystem) --sourcedirectory=@(directory) --builddirectory=$(BUILD_DIR)/@(name) -- \
+		-DCMAKE_INSTALL_PREFIX="@(InstallationPrefix)" \
+		-DCMAKE_PREFIX_PATH="$(STAGING_PREFIX_PATH)"@
+@[if build_type == 'catkin'] \
+		-DCATKIN_BUILD_BINARY_PACKAGE="1"@[end if]@
+@[if build_type == 'ament_cmake'] \
+		-DAMENT_PREFIX_PATH="@(InstallationPrefix)"@[end if]@
+@[if CMakeArgs] \
+		$(CMAKE_ARGS)@[end if] && \
+@[if CMakeBuildSystem == 'cmake+ninja']@
+	ninja -C $(BUILD_DIR)/@(name) && \
+	DESTDIR=$(STAGING_DIR)/@(package) ninja -C $(BUILD_DIR)/@(name) install
+@[else]@
+	$(MAKE) -C $(BUILD_DIR)/@(name) && \
+	$(MAKE) -C $(BUILD_DIR)/@(name) install DESTDIR=$(STAGING_DIR)/@(package)
+@[end if]@
+@[end if]@
+@[end for]@
+@[end for]@
+@[else]@
 override_dh_auto_configure:
 	# In case we're installing to a non-standard location, look for a setup.sh
 	# in the install tree that was dropped by catkin, and source it.  It will
@@ -28,14 +113,22 @@ override_dh_auto_configure:
 	if [ -f "@(InstallationPrefix)/setup.sh" ]; then . "@(InstallationPrefix)/setup.sh"; fi && \
 	dh_auto_configure -- \
 		-DCMAKE_INSTALL_PREFIX="@(InstallationPrefix)" \
-		-DAMENT_PREFIX_PATH="@(InstallationPrefix)"
+		-DAMENT_PREFIX_PATH="@(InstallationPrefix)"@
+@[if CMakeArgs] \
+		$(CMAKE_ARGS)@[end if]@
+@[for python_dir, install_scripts in PythonPackages] && \
+	dh_auto_configure --buildsystem=pybuild --sourcedirectory=@(python_dir)@
+@[end for]
 
 override_dh_auto_build:
 	# In case we're installing to a non-standard location, look for a setup.sh
 	# in the install tree that was dropped by catkin, and source it.  It will
 	# set things like CMAKE_PREFIX_PATH, PKG_CONFIG_PATH, and PYTHONPATH.
 	if [ -f "@(InstallationPrefix)/setup.sh" ]; then . "@(InstallationPrefix)/setup.sh"; fi && \
-	dh_auto_build
+	dh_auto_build@
+@[for python_dir, install_scripts in PythonPackages] && \
+	dh_auto_build --buildsystem=pybuild --sourcedirectory=@(python_dir)@
+@[end for]
 
 override_dh_auto_test:
 	# In case we're installing to a non-standard location, look for a setup.sh
@@ -43,18 +136,47 @@ override_dh_auto_test:
 	# set things like CMAKE_PREFIX_PATH, PKG_CONFIG_PATH, and PYTHONPATH.
 	echo -- Running tests. Even if one of them fails the build is not canceled.
 	if [ -f "@(InstallationPrefix)/setup.sh" ]; then . "@(InstallationPrefix)/setup.sh"; fi && \
-	dh_auto_test || true
+	dh_auto_test || true@
+@[for python_dir, install_scripts in PythonPackages]; \
+	dh_auto_test --buildsystem=pybuild --sourcedirectory=@(python_dir) || true@
+@[end for]
+@[end if]@
+
+@[if BinaryVersions]@
+# The changed packages whose version differs from the one of the source
+# package, the unchanged packages are not in the control file at all
+override_dh_gencontrol:
+@[for package, version in BinaryVersions]@
+	dh_gencontrol -p@(package) -- -v@(version)
+@[end for]@
+	dh_gencontrol --remaining-packages
 
+@[end if]@
 override_dh_shlibdeps:
 	# In case we're installing to a non-standard location, look for a setup.sh
 	# in the install tree that was dropped by catkin, and source it.  It will
 	# set things like CMAKE_PREFIX_PATH, PKG_CONFIG_PATH, and PYTHONPATH.
 	if [ -f "@(InstallationPrefix)/setup.sh" ]; then . "@(InstallationPrefix)/setup.sh"; fi && \
-	dh_shlibdeps -l$(CURDIR)/debian/@(Package)/@(InstallationPrefix)/lib/
+	dh_shlibdeps -l@
+@[for index, (name, package, directory, build_type, install_scripts) in enumerate(Packages)]@(':' if index else '')$(CURDIR)/debian/@(package)@(InstallationPrefix)/lib@[end for]
+
+@[if not BuildWaves]@
+# The folder dh_auto_configure configures the repository root in, each CMake
+# package is installed with the install script of its folder in it
+DEB_HOST_GNU_TYPE ?= $(shell dpkg-architecture -qDEB_HOST_GNU_TYPE)
+BUILD_DIR = $(CURDIR)/obj-$(DEB_HOST_GNU_TYPE)
 
 override_dh_auto_install:
 	# In case we're installing to a non-standard location, look for a setup.sh
 	# in the install tree that was dropped by catkin, and source it.  It will
 	# set things like CMAKE_PREFIX_PATH, PKG_CONFIG_PATH, and PYTHONPATH.
-	if [ -f "@(InstallationPrefix)/setup.sh" ]; then . "@(InstallationPrefix)/setup.sh"; fi && \
-	dh_auto_install
+	if [ -f "@(InstallationPrefix)/setup.sh" ]; then . "@(InstallationPrefix)/setup.sh"; fi@
+@[for name, package, directory, build_type, install_scripts in Packages] && \
+@[if build_type == 'ament_python']@
+	dh_auto_install --buildsystem=pybuild --sourcedirectory=@(directory) --destdir=$(STAGING_DIR)/@(package) -- \
+		--install-args='$(PYBUILD_INSTALL_ARGS_BASE)@[if install_scripts] --install-scripts "\$$base/bin"@[end if]'@
+@[else]@
+	DESTDIR=$(STAGING_DIR)/@(package) cmake -P $(BUILD_DIR)/@(directory)/cmake_install.cmake@
+@[end if]@
+@[end for]
+@[end if]@
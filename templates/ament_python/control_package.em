@@ -1,14 +1,7 @@
-Source: @(Package)
-Section: misc
-Priority: optional
-Maintainer: @(Maintainer)
-Build-Depends: debhelper (>= @(debhelper_version).0.0), @(', '.join(BuildDepends)), python3-all, python3-setuptools
-Homepage: @(Homepage)
-Standards-Version: 3.9.2
-
 Package: @(Package)
 Architecture: any
 Depends: ${python3:Depends}, ${misc:Depends}, @(', '.join(Depends))
 @[if Conflicts]Conflicts: @(', '.join(Conflicts))@\n@[end if]@
 @[if Replaces]Replaces: @(', '.join(Replaces))@\n@[end if]@
 Description: @(Description)
+
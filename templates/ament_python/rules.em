@@ -18,10 +18,13 @@ export PKG_CONFIG_PATH=@(InstallationPrefix)/lib/pkgconfig
 # 	https://github.com/ros-infrastructure/bloom/issues/327
 export DEB_CXXFLAGS_MAINT_APPEND=-DNDEBUG
 
-# Python package installation variables
-export PYBUILD_INSTALL_ARGS=--prefix "@(InstallationPrefix)" \
-	--install-lib "\$$base/lib/{interpreter}/site-packages" \
-	@[ if pass_install_scripts ] --install-scripts "\$$base/bin" @[end if]
+# Every package is installed into its own folder in debian/tmp, which its
+# debian/<package>.install moves into the package
+STAGING_DIR = $(CURDIR)/debian/tmp
+
+# Python package installation variables, each package is built from its own folder
+PYBUILD_INSTALL_ARGS_BASE = --prefix "@(InstallationPrefix)" \
+	--install-lib "\$$base/lib/{interpreter}/site-packages"
 
 %:
 	dh $@@ -v --buildsystem=pybuild --with python3
@@ -31,14 +34,20 @@ override_dh_auto_configure:
 	# in the install tree that was dropped by catkin, and source it.  It will
 	# set things like CMAKE_PREFIX_PATH, PKG_CONFIG_PATH, and PYTHONPATH.
 	if [ -f "@(InstallationPrefix)/setup.sh" ]; then . "@(InstallationPrefix)/setup.sh"; fi && \
-	dh_auto_configure
+	true@
+@[for python_dir, install_scripts in PythonPackages] && \
+	dh_auto_configure --sourcedirectory=@(python_dir)@
+@[end for]
 
 override_dh_auto_build:
 	# In case we're installing to a non-standard location, look for a setup.sh
 	# in the install tree that was dropped by catkin, and source it.  It will
 	# set things like CMAKE_PREFIX_PATH, PKG_CONFIG_PATH, and PYTHONPATH.
 	if [ -f "@(InstallationPrefix)/setup.sh" ]; then . "@(InstallationPrefix)/setup.sh"; fi && \
-	dh_auto_build
+	true@
+@[for python_dir, install_scripts in PythonPackages] && \
+	dh_auto_build --sourcedirectory=@(python_dir)@
+@[end for]
 
 override_dh_auto_test:
 	# In case we're installing to a non-standard location, look for a setup.sh
@@ -46,18 +55,36 @@ override_dh_auto_test:
 	# set things like CMAKE_PREFIX_PATH, PKG_CONFIG_PATH, and PYTHONPATH.
 	echo -- Running tests. Even if one of them fails the build is not canceled.
 	if [ -f "@(InstallationPrefix)/setup.sh" ]; then . "@(InstallationPrefix)/setup.sh"; fi && \
-	dh_auto_test || true
+	true@
+@[for python_dir, install_scripts in PythonPackages]; \
+	dh_auto_test --sourcedirectory=@(python_dir) || true@
+@[end for]
+
+@[if BinaryVersions]@
+# The changed packages whose version differs from the one of the source
+# package, the unchanged packages are not in the control file at all
+override_dh_gencontrol:
+@[for package, version in BinaryVersions]@
+	dh_gencontrol -p@(package) -- -v@(version)
+@[end for]@
+	dh_gencontrol --remaining-packages
 
+@[end if]@
 override_dh_shlibdeps:
 	# In case we're installing to a non-standard location, look for a setup.sh
 	# in the install tree that was dropped by catkin, and source it.  It will
 	# set things like CMAKE_PREFIX_PATH, PKG_CONFIG_PATH, and PYTHONPATH.
 	if [ -f "@(InstallationPrefix)/setup.sh" ]; then . "@(InstallationPrefix)/setup.sh"; fi && \
-	dh_shlibdeps -l$(CURDIR)/debian/@(Package)/@(InstallationPrefix)/lib/
+	dh_shlibdeps -l@
+@[for index, (name, package, directory, build_type, install_scripts) in enumerate(Packages)]@(':' if index else '')$(CURDIR)/debian/@(package)@(InstallationPrefix)/lib@[end for]
 
 override_dh_auto_install:
 	# In case we're installing to a non-standard location, look for a setup.sh
 	# in the install tree that was dropped by catkin, and source it.  It will
 	# set things like CMAKE_PREFIX_PATH, PKG_CONFIG_PATH, and PYTHONPATH.
 	if [ -f "@(InstallationPrefix)/setup.sh" ]; then . "@(InstallationPrefix)/setup.sh"; fi && \
-	dh_auto_install
+	true@
+@[for name, package, directory, build_type, install_scripts in Packages] && \
+	dh_auto_install --sourcedirectory=@(directory) --destdir=$(STAGING_DIR)/@(package) -- \
+		--install-args='$(PYBUILD_INSTALL_ARGS_BASE)@[if install_scripts] --install-scripts "\$$base/bin"@[end if]'@
+@[end for]
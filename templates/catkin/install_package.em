@@ -0,0 +1 @@
+debian/tmp/@(Package)@(InstallationPrefix)/* @(InstallationPrefix)